@@ -1,4 +1,6 @@
 import sys, os, argparse
+import fcntl
+import multiprocessing
 import torch
 import data, lstm
 import pickle, pandas
@@ -6,101 +8,593 @@ import time
 import copy
 import numpy as np
 
+from statistics import NormalDist
 from tqdm import tqdm
 from torch.autograd import Variable
 from predict import *
+from tasks import subset_task
+
+
+def ablation_masks(model, unit_sets, cuda):
+    """
+    Masks for lstm.forward with the same effect as model.ablate(units), with one row
+    per set of units, so that the ablations can be evaluated as one batch.
+    Args:
+        model (model.RNNModel): model that is evaluated
+        unit_sets (list): lists of units that are ablated together
+        cuda (bool): put the masks on the GPU
+    Returns:
+        dict: recurrent_mask and output_mask keyword arguments
+    """
+    recurrent_mask = {l: torch.ones(len(unit_sets), model.nhid)
+        for l in range(model.nlayers)}
+    output_mask = torch.ones(len(unit_sets), model.nhid)
+
+    for i, units in enumerate(unit_sets):
+        for u in units:
+            if not model.nhid * model.nlayers > u >= 0:
+                sys.exit("Invalid unit number")
+            layer, column = divmod(u, model.nhid)
+            recurrent_mask[layer][i, column] = 0
+            # Units in the last layer also lose their decoder weights
+            if layer == model.nlayers - 1:
+                output_mask[i, column] = 0
+
+    if cuda:
+        recurrent_mask = {l: m.cuda() for l, m in recurrent_mask.items()}
+        output_mask = output_mask.cuda()
+
+    return {"recurrent_mask": recurrent_mask, "output_mask": output_mask}
+
+
+def masked_warm_up(model, vocab, runs, args, cache=None):
+    """
+    Returns:
+        tuple: initial state of every run, one column per run, as expected
+               by get_predictions_masked
+    """
+    sentence = " ".join([f". {args.eos}"] * 5)
+
+    # Only warm up the ablations that are not cached yet
+    states = [cache.get(sentence, units) if cache else None for _, units in runs]
+    missing = [i for i, state in enumerate(states) if state is None]
+    if missing:
+        missing_units = [runs[i][1] for i in missing]
+        init_h = warm_up(model, vocab, args.cuda, sentence, len(missing),
+            **ablation_masks(model, missing_units, args.cuda))
+        for j, i in enumerate(missing):
+            states[i] = tuple(h[:, j:j+1].cpu() for h in init_h)
+            if cache is not None:
+                cache.put(sentence, runs[i][1], states[i])
+    init_h = tuple(torch.cat([state[k] for state in states], 1) for k in range(2))
+    if args.cuda:
+        init_h = tuple(h.cuda() for h in init_h)
+    return init_h
 
-parser = argparse.ArgumentParser()
-parser.add_argument("-m", "--model", type=str, default="models/model.pt",
-    help="Model (meta file) to use")
-parser.add_argument("-i", "--input", type=str, required=True,
-    help="Input sentences (tsv file)")
-parser.add_argument("-o", "--output", type=str, default="output_ablation")
-parser.add_argument("-v", "--vocabulary", type=str,
-    default="data/vocabulary/vocab.txt",
-    help="Vocabulary of the training corpus that the model was trained on")
-parser.add_argument("-u", "--unit", type=int, default=-1,
-    help="Network unit to ablate")
-parser.add_argument("--range_end", type=int, default=-1,
-    help="End (inclusive) of the range of units to ablate")
-parser.add_argument("-s", "--seed", type=int, default=5,
-    help="Random seed for adding random units")
-parser.add_argument("--number_of_units", type=int, default=1300)
-parser.add_argument("--eos", type=str, default="<eos>",
-    help="Token that indicates end of sentence")
-parser.add_argument("--unk", type=str, default="<unk>",
-    help="Token that indicates an unknown token"),
-parser.add_argument("--cuda", action="store_true", default=False)
-
-args = parser.parse_args()
-
-if not os.path.exists(args.output):
-    os.makedirs(args.output)
-template = args.input.split("/")[-1].replace(".tsv", "")
-output_fn = f"{template}.info"
-
-# Create Dictionary object from the vocabulary
-vocab = data.Dictionary(args.vocabulary)
-data = pandas.read_csv(args.input, sep="\t", header=0)
-header = list(data)
-sentences = data.loc[:, "agreement"]
-
-model = load_model(args.model, args.cuda)
-units = []
-
-if 1300 > args.unit > -1:
-    units = [args.unit]
-    if 1300 > args.range_end > args.unit:
-        units = list(range(args.unit, args.range_end+1))
-
-# Will be skipped if there are no units to ablate
-for u in units:
-    if u < 650:
-        target_unit = torch.LongTensor(np.array([[int(u)]]))
-        if args.cuda:
-            target_unit.cuda()
-        model.rnn.weight_hh_l0.data[:, target_unit] = 0
 
-    elif 1300 > u > 649:
-        target_unit = torch.LongTensor(np.array([[int(u)-650]]))
+def evaluate_masked(model, vocab, tasks, runs, args, cache=None,
+        layer_caches=None):
+    """
+    Evaluate all runs as one batch, with masks instead of changing weights.
+    Returns:
+        list: for every task, the output of categorise_predictions per run
+    """
+    masks = ablation_masks(model, [units for _, units in runs], args.cuda)
+    init_h = masked_warm_up(model, vocab, runs, args, cache)
+
+    outs = []
+    layer_caches = layer_caches or [None] * len(tasks)
+    for (template, task_data, task), layer_cache in zip(tasks, layer_caches):
+        log_p_targets_correct, log_p_targets_wrong =\
+            get_predictions_masked(task, model, init_h, masks, args.cuda,
+                args.batch_size, args.log_odds, layer_cache)
+        outs.append([categorise_predictions(task_data, task_data.index,
+                log_p_targets_correct[:, [i]], log_p_targets_wrong[:, [i]])
+            for i in range(len(runs))])
+    return outs
+
+
+def condition_labels(task_data):
+    # Number condition of every sentence, split as in categorise_predictions
+    if len(task_data.columns) == 0:
+        return np.full(len(task_data), "all")
+    return task_data.apply("_".join, axis=1).values
+
+
+def unit_attribution(model, vocab, task, task_data, args):
+    """
+    First-order estimate of the change in log odds of the correct over the
+    wrong verb when a unit is ablated on its own (as with --ablation
+    recurrent), for all units at once. Every sentence gets masks of ones,
+    as in ablation_masks, in the warm-up and in the sentence; ablating a unit
+    sets its mask to 0, so the change is about minus the gradient of the log
+    odds with respect to the mask. One forward and backward pass per batch.
+    Returns:
+        pandas.DataFrame: mean estimated change per unit (rows, named as in
+                          the .info files) and number condition (columns)
+    """
+    sentence = " ".join([f". {args.eos}"] * 5)
+    n_units = model.nhid * model.nlayers
+    delta = np.zeros((len(task["verb_index"]), n_units), dtype=np.float32)
+
+    batches = length_batches(task, args.attribution_batch_size)
+    for rows, input in tqdm(batches):
+        input = torch.from_numpy(input)
+        targets = torch.from_numpy(np.stack(
+            [task["correct_verb"][rows], task["incorrect_verb"][rows]], 1))
         if args.cuda:
-            target_unit.cuda()
-        model.rnn.weight_hh_l1.data[:, target_unit] = 0
-        model.decoder.weight.data[:, target_unit] = 0
+            input, targets = input.cuda(), targets.cuda()
+
+        recurrent_mask = {l: torch.ones(len(rows), model.nhid,
+                device=input.device, requires_grad=True)
+            for l in range(model.nlayers)}
+        output_mask = torch.ones(len(rows), model.nhid, device=input.device,
+            requires_grad=True)
+        masks = {"recurrent_mask": recurrent_mask, "output_mask": output_mask}
+
+        # Every row has its own masks, so the gradient of the summed log odds
+        # with respect to a row of the masks is that of its own sentence
+        init_h = warm_up(model, vocab, args.cuda, sentence, len(rows), True,
+            **masks)
+        with torch.enable_grad():
+            out, _ = model.rnn_forward(input, init_h, record=False, **masks)
+            scores = model.score_targets(out[-1], targets, False)
+            grads = torch.autograd.grad((scores[:, 0] - scores[:, 1]).sum(),
+                list(recurrent_mask.values()) + [output_mask])
+
+        for l in range(model.nlayers):
+            delta[rows, l * model.nhid:(l + 1) * model.nhid] =\
+                -grads[l].cpu().numpy()
+        # Units in the last layer also lose their decoder weights
+        delta[rows, -model.nhid:] -= grads[-1].cpu().numpy()
+
+    df = pandas.DataFrame(delta).groupby(condition_labels(task_data)).mean().T
+    df.index = df.index.astype(str)
+    return df
+
+
+def select_units(attributions, top_k):
+    """
+    Args:
+        attributions (list): outputs of unit_attribution
+        top_k (int): number of units to keep
+    Returns:
+        list: the top_k units with the largest estimated drop in log odds in
+              any condition of any task, largest first
+    """
+    drop = pandas.concat(attributions, axis=1).min(axis=1)
+    return [int(u) for u in drop.sort_values().index[:top_k]]
+
+
+def evaluate(model, vocab, tasks, args, units=(), cache=None,
+        layer_caches=None):
+    # The initial state depends on the ablation, but not on the template
+    init_h = cached_warm_up(model, vocab, args.cuda,
+        " ".join([f". {args.eos}"] * 5), cache, units, args.ablation)
+
+    layer_caches = layer_caches or [None] * len(tasks)
+    return [evaluate_task(task_data, task, model, init_h, vocab, args,
+            layer_cache=layer_cache)
+        for (_, task_data, task), layer_cache in zip(tasks, layer_caches)]
+
+
+def layer_caches(model, vocab, tasks, args, cache=None):
+    """
+    Returns:
+        list: for every task, a LayerCache of the output of layer 0 of the
+              unablated model, which stays the same when only units of later
+              layers are ablated (with any kind of ablation)
+    """
+    init_h = cached_warm_up(model, vocab, args.cuda,
+        " ".join([f". {args.eos}"] * 5), cache)
+    if args.layer_cache_dir and not os.path.exists(args.layer_cache_dir):
+        os.makedirs(args.layer_cache_dir, exist_ok=True)
+
+    caches = []
+    for template, _, task in tasks:
+        print(f"Caching the output of layer 0 on {template}")
+        path = None
+        if args.layer_cache_dir:
+            path = os.path.join(args.layer_cache_dir,
+                f"{template}.layer0.{os.getpid()}.npy")
+        caches.append(LayerCache(task, model, init_h, 1, args.cuda,
+            args.batch_size, path))
+    return caches
+
+
+def replays(model, unit_sets):
+    # Whether a LayerCache of layer 0 can be used for these ablations
+    return all(u >= model.nhid for units in unit_sets for u in units)
+
+
+def predict_runs(model, vocab, task, runs, args, init_h=None, cache=None):
+    """
+    Score the verbs of a task under every run: with masks when
+    --units_per_batch > 1, starting from init_h (see masked_warm_up), and by
+    changing the weights otherwise.
+    Returns:
+        np.ndarray: [sentences, runs] log probabilities of the correct verbs
+        np.ndarray: [sentences, runs] log probabilities of the wrong verbs
+    """
+    shape = (len(task["verb_index"]), len(runs))
+    log_p_targets_correct, log_p_targets_wrong = np.zeros(shape), np.zeros(shape)
+
+    if args.units_per_batch > 1:
+        for start in range(0, len(runs), args.units_per_batch):
+            batch = slice(start, start + args.units_per_batch)
+            masks = ablation_masks(model, [units for _, units in runs[batch]],
+                args.cuda)
+            log_p_targets_correct[:, batch], log_p_targets_wrong[:, batch] =\
+                get_predictions_masked(task, model,
+                    tuple(h[:, batch] for h in init_h), masks, args.cuda,
+                    args.batch_size, args.log_odds)
+    else:
+        for i, (_, units) in enumerate(runs):
+            with model.ablate(units, args.ablation):
+                run_h = cached_warm_up(model, vocab, args.cuda,
+                    " ".join([f". {args.eos}"] * 5), cache, units, args.ablation)
+                correct, wrong = get_predictions_batched(task, model, run_h,
+                    args.cuda, args.batch_size, args.log_odds)
+            log_p_targets_correct[:, i] = correct[:, 0]
+            log_p_targets_wrong[:, i] = wrong[:, 0]
+
+    return log_p_targets_correct, log_p_targets_wrong
+
 
+def early_stop(baseline, correct, evaluated, conditions, threshold, z):
+    """
+    The drop in accuracy of a condition is the mean difference between the
+    correctness of the unablated and the ablated model on the same sentences,
+    with a normal bound of z standard errors. The finite population correction
+    makes the bound 0 once all sentences of a condition are evaluated, and the
+    variance is at least that of one difference in n sentences, so that a few
+    sentences without any difference are not taken as certain.
+    Args:
+        baseline (np.ndarray): whether the unablated model is correct
+        correct (np.ndarray): whether the ablated model is correct
+        evaluated (np.ndarray): whether the sentence was evaluated
+        conditions (np.ndarray): number condition of every sentence
+        threshold (float): drop in accuracy that singles out a unit
+        z (float): width of the bound in standard errors
+    Returns:
+        str: "above" if the drop is clearly above threshold in a condition,
+             "below" if it is clearly below it in all of them, else None
+    """
+    below = True
+    for c in np.unique(conditions):
+        in_condition = conditions == c
+        rows = in_condition & evaluated
+        n, total = rows.sum(), in_condition.sum()
+        if n == 0:
+            below = False
+            continue
+
+        drop = baseline[rows].astype(float) - correct[rows]
+        variance = max(drop.var(ddof=1) if n > 1 else 1.0, 1 / n)
+        bound = z * np.sqrt(variance / n * (total - n) / max(total - 1, 1))
+        if drop.mean() - bound > threshold:
+            return "above"
+        if drop.mean() + bound >= threshold:
+            below = False
+
+    return "below" if below else None
+
+
+def sequential_ablation(model, vocab, task, task_data, runs, args, cache=None):
+    """
+    Evaluate the runs on a growing, stratified sample of the sentences: every
+    stage adds --chunk_size random sentences of each number condition, and a
+    run is no longer evaluated once early_stop decides on it, so that only
+    units close to --threshold are evaluated on all sentences.
+    Returns:
+        list: for every run, the output of categorise_predictions on the
+              sentences it was evaluated on, with their indices as "rows"
+              and the decision of early_stop as "early_stop"
+    """
+    conditions = condition_labels(task_data)
+    rng = np.random.RandomState(args.seed)
+    orders = [rng.permutation(np.flatnonzero(conditions == c))
+        for c in np.unique(conditions)]
+    z = NormalDist().inv_cdf(args.confidence)
+
+    # Correctness of the unablated model on every sentence
+    init_h = cached_warm_up(model, vocab, args.cuda,
+        " ".join([f". {args.eos}"] * 5), cache)
+    correct, wrong = get_predictions_batched(task, model, init_h, args.cuda,
+        args.batch_size, args.log_odds)
+    baseline = (correct > wrong)[:, 0]
+
+    log_p_targets_correct = np.full((len(conditions), len(runs)), np.nan)
+    log_p_targets_wrong = np.full((len(conditions), len(runs)), np.nan)
+    decisions = [None] * len(runs)
+    runs_h = masked_warm_up(model, vocab, runs, args, cache)\
+        if args.units_per_batch > 1 else None
+
+    active = np.arange(len(runs))
+    for start in range(0, max(len(order) for order in orders), args.chunk_size):
+        rows = np.concatenate([order[start:start + args.chunk_size]
+            for order in orders])
+        print(f"Evaluating {len(active)} runs on {len(rows)} more sentences")
+        active_h = None
+        if runs_h is not None:
+            active_h = tuple(h[:, active] for h in runs_h)
+        correct, wrong = predict_runs(model, vocab, subset_task(task, rows),
+            [runs[i] for i in active], args, active_h, cache)
+        log_p_targets_correct[np.ix_(rows, active)] = correct
+        log_p_targets_wrong[np.ix_(rows, active)] = wrong
+
+        for i in active:
+            evaluated = ~np.isnan(log_p_targets_correct[:, i])
+            decisions[i] = early_stop(baseline,
+                log_p_targets_correct[:, i] > log_p_targets_wrong[:, i],
+                evaluated, conditions, args.threshold, z)
+        active = np.array([i for i in active if decisions[i] is None], dtype=int)
+        if len(active) == 0:
+            break
+
+    outs = []
+    for i in range(len(runs)):
+        rows = np.flatnonzero(~np.isnan(log_p_targets_correct[:, i]))
+        info = categorise_predictions(task_data.iloc[rows].reset_index(drop=True),
+            rows, log_p_targets_correct[rows][:, [i]],
+            log_p_targets_wrong[rows][:, [i]])
+        info["rows"] = rows
+        info["early_stop"] = decisions[i]
+        outs.append(info)
+
+    n_evaluated = int((~np.isnan(log_p_targets_correct)).sum())
+    print(f"Evaluated {n_evaluated} of {log_p_targets_correct.size} sentences "
+          f"over all runs")
+    return outs
+
+
+def get_runs(args):
+    """
+    Returns:
+        list: (key in the .info file, units to ablate) for every evaluation,
+              where a key of None stands for the unablated model
+    """
+    units = []
+    if args.number_of_units > args.unit > -1:
+        units = [args.unit]
+        if args.number_of_units > args.range_end > args.unit:
+            units = list(range(args.unit, args.range_end+1))
+
+    if args.sweep:
+        return [(str(u), [u]) for u in units]
+    if args.range_end > args.unit > -1:
+        return [(f"{args.unit}-{args.range_end}", units)]
+    if args.unit > -1:
+        return [(str(args.unit), units)]
+    return [(None, units)]
+
+
+def load_inputs(args):
+    # Create Dictionary object from the vocabulary
+    vocab = data.Dictionary(args.vocabulary)
+    tasks = read_tasks(args.input, vocab, args.unk)
+    model = load_model(args.model, args.cuda)
+
+    cache = None
+    if args.warm_up_cache:
+        cache = WarmUpCache(checkpoint_hash(args.model), args.warm_up_cache)
+
+    return model, vocab, tasks, cache
+
+
+def run_ablations(model, vocab, tasks, runs, args, cache=None):
+    """
+    Returns:
+        dict: for every template, (key, output of categorise_predictions) for
+              every run
+    """
+    results = {template: [] for template, _, _ in tasks}
+
+    # Runs that only ablate units of layer 1 replay it from the cached output
+    # of layer 0
+    caches = None
+    if args.layer_cache and not args.sequential:
+        caches = layer_caches(model, vocab, tasks, args, cache)
+
+    if args.sequential:
+        for template, task_data, task in tasks:
+            print(f"Ablating {len(runs)} runs on {template} in stages")
+            outs = sequential_ablation(model, vocab, task, task_data, runs,
+                args, cache)
+            results[template] = [(key, out) for (key, _), out in zip(runs, outs)]
+
+    elif args.units_per_batch > 1:
+        for start in range(0, len(runs), args.units_per_batch):
+            batch = runs[start:start + args.units_per_batch]
+            print(f"Ablating {batch[0][0]} to {batch[-1][0]}")
+            outs = evaluate_masked(model, vocab, tasks, batch, args, cache,
+                caches if replays(model, [units for _, units in batch]) else None)
+            for (template, _, _), task_outs in zip(tasks, outs):
+                results[template].extend(
+                    (key, out) for (key, _), out in zip(batch, task_outs))
+
+    # Every run starts from the unablated weights: only the zeroed columns are
+    # restored afterwards, the model is not loaded again
     else:
-        sys.exit("Invalid unit number")
+        for key, units in runs:
+            if key is not None:
+                print(f"Ablating {key}")
+            with model.ablate(units, args.ablation):
+                outs = evaluate(model, vocab, tasks, args, units, cache,
+                    caches if replays(model, [units]) else None)
+            for (template, _, _), out in zip(tasks, outs):
+                results[template].append((key, out))
+
+    # Memory-mapped outputs are only used by this process
+    if caches and args.layer_cache_dir:
+        for layer_cache in caches:
+            path = layer_cache.outputs.filename
+            del layer_cache.outputs
+            os.remove(path)
+
+    return results
+
+
+def run_shard(args, runs, path):
+    # Entry point of a worker process: results are written to a shard file,
+    # which is merged into the .info files by the main process
+    torch.set_num_threads(args.threads)
+    model, vocab, tasks, cache = load_inputs(args)
+    results = run_ablations(model, vocab, tasks, runs, args, cache)
 
+    with open(path, "wb") as f:
+        pickle.dump(results, f, -1)
+    return path
 
-# Initial sentences are all . <eos>, feed these to the model
-# (Do not start in the original state)
-init_sentence = " ".join([". <eos>"] * 5)
-hidden = model.init_hidden(1)
-init_out, init_h = feed_sentence(model, hidden, init_sentence.split(" "), vocab,
-    args.cuda)
 
-log_p_targets_correct, log_p_targets_wrong =\
-    get_predictions(data, sentences, model, init_out, init_h, vocab, args.cuda)
-out = categorise_predictions(data, sentences, log_p_targets_correct,
-    log_p_targets_wrong)
+def save_info(path, results):
+    """
+    Merge results into the .info file at path. The file is locked while it is
+    read and written, and replaced in one step, so runs that finish at the
+    same time do not overwrite each other's results.
+    Args:
+        path (str): .info file
+        results (list): (key, info) pairs; a key of None replaces the contents
+    """
+    with open(f"{path}.lock", "w") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
 
-template = args.input.split("/")[-1].replace(".tsv", "")
-info = {}
+        info = {}
+        try:
+            with open(path, "rb") as f:
+                info = pickle.load(f)
+        except Exception:
+            pass
 
-try:
-    with open(os.path.join(args.output, output_fn), "rb") as f:
-        info = pickle.load(f)
-except Exception:
-    pass
+        for key, out in results:
+            if key is None:
+                info = out
+            else:
+                info[key] = out
 
-if args.range_end > args.unit > -1:
-    info[f"{args.unit}-{args.range_end}"] = out
-elif args.unit > -1:
-    info[str(args.unit)] = out
-else:
-    info = out
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, "wb") as f:
+            pickle.dump(info, f, -1)
+        os.replace(tmp_path, path)
 
-with open(os.path.join(args.output, output_fn), "wb") as f:
-    pickle.dump(info, f, -1)
 
-print(f"Information saved to {args.output}/{output_fn}\n")
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-m", "--model", type=str, default="models/model.pt",
+        help="Model (meta file) to use")
+    parser.add_argument("-i", "--input", type=str, nargs="+", required=True,
+        help="Input sentences (tsv files or directories of tsv files)")
+    parser.add_argument("-o", "--output", type=str, default="output_ablation")
+    parser.add_argument("-u", "--unit", type=int, default=-1,
+        help="Network unit to ablate")
+    parser.add_argument("--range_end", type=int, default=-1,
+        help="End (inclusive) of the range of units to ablate")
+    parser.add_argument("--sweep", action="store_true", default=False,
+        help="Ablate every unit from --unit to --range_end on its own, loading "
+        "the model and data only once")
+    parser.add_argument("--ablation", type=str, default="recurrent",
+        choices=["recurrent", "input", "output_gate"],
+        help="Weights to zero: recurrent (and decoder) weights of the units, "
+        "their input-to-hidden weights, or their output gate")
+    parser.add_argument("--units_per_batch", type=int, default=1,
+        help="Number of ablations to evaluate at once with --sweep, using masks "
+        "instead of changing the weights")
+    parser.add_argument("--attribution_top_k", type=int, default=0,
+        help="With --sweep, first estimate the effect of every unit from "
+        "gradients and only ablate the k units with the largest estimated drop")
+    parser.add_argument("--attribution_batch_size", type=int, default=64,
+        help="Number of sentences per forward and backward pass of the "
+        "estimate, independently of -b")
+    parser.add_argument("--sequential", action="store_true", default=False,
+        help="Evaluate every run on growing samples of --chunk_size sentences "
+        "per condition, until its drop in accuracy is clearly below or above "
+        "--threshold")
+    parser.add_argument("--chunk_size", type=int, default=100,
+        help="Sentences per number condition added at every stage of "
+        "--sequential")
+    parser.add_argument("--threshold", type=float, default=0.1,
+        help="Drop in accuracy in any condition that singles out a unit, as "
+        "in find_unit.py (0.08 for that_nounpp)")
+    parser.add_argument("--confidence", type=float, default=0.99,
+        help="One-sided confidence level of the bounds on the drop in accuracy")
+    parser.add_argument("--layer_cache", action="store_true", default=False,
+        help="Compute the output of layer 0 once and only feed layer 1 for "
+        "ablations of units in layer 1 (not with --sequential)")
+    parser.add_argument("--layer_cache_dir", type=str, default=None,
+        help="Keep the cached output of layer 0 in memory-mapped files in this "
+        "directory instead of in memory")
+    parser.add_argument("-w", "--workers", type=int, default=1,
+        help="Number of processes to spread the runs over")
+    parser.add_argument("--threads", type=int, default=-1,
+        help="Number of torch threads of the main process and of every worker "
+        "(default: cores / workers)")
+    parser.add_argument("-s", "--seed", type=int, default=5,
+        help="Random seed for adding random units and for the order of the "
+        "sentences with --sequential")
+    parser.add_argument("--number_of_units", type=int, default=1300)
+    add_evaluation_arguments(parser)
+
+    args = parser.parse_args()
+    if args.units_per_batch > 1 and args.ablation != "recurrent":
+        sys.exit("--units_per_batch only supports --ablation recurrent")
+    if args.attribution_top_k > 0 and (not args.sweep or args.ablation != "recurrent"):
+        sys.exit("--attribution_top_k needs --sweep and --ablation recurrent")
+    if args.threads < 1:
+        args.threads = max(1, (os.cpu_count() or 1) // args.workers)
+    torch.set_num_threads(args.threads)
+
+    if not os.path.exists(args.output):
+        os.makedirs(args.output)
+    runs = get_runs(args)
+
+    inputs = None
+    if args.attribution_top_k > 0:
+        # Rank the units of the sweep by their estimated effect, and only
+        # ablate the top ones
+        inputs = load_inputs(args)
+        model, vocab, tasks, cache = inputs
+        attributions = []
+        for template, task_data, task in tasks:
+            print(f"Estimating the effect of every unit on {template}")
+            attribution = unit_attribution(model, vocab, task, task_data, args)
+            attribution.to_csv(os.path.join(args.output,
+                f"{template}.attribution.csv"))
+            attributions.append(attribution.loc[[key for key, _ in runs]])
+        selected = select_units(attributions, args.attribution_top_k)
+        print(f"Ablating units {' '.join(map(str, selected))}")
+        runs = [(str(u), [u]) for u in selected]
+
+    if args.workers > 1 and len(runs) > 1:
+        # Contiguous shards of runs, each evaluated by a worker with its own
+        # copy of the model that writes to its own shard file
+        size = -(-len(runs) // args.workers)
+        shards = [(args, runs[start:start + size],
+                os.path.join(args.output, f"ablation.{os.getpid()}.shard{k}"))
+            for k, start in enumerate(range(0, len(runs), size))]
+        try:
+            with multiprocessing.get_context("spawn").Pool(len(shards)) as pool:
+                shard_paths = pool.starmap(run_shard, shards)
+
+            results = {}
+            for path in shard_paths:
+                with open(path, "rb") as f:
+                    for template, template_results in pickle.load(f).items():
+                        results.setdefault(template, []).extend(template_results)
+        finally:
+            # Also the shards of workers that finished if another one failed
+            for _, _, path in shards:
+                if os.path.exists(path):
+                    os.remove(path)
+
+    else:
+        model, vocab, tasks, cache = inputs or load_inputs(args)
+        results = run_ablations(model, vocab, tasks, runs, args, cache)
+
+    store = ResultsStore(args.results_db) if args.results_db else None
+    for template, template_results in results.items():
+        output_path = os.path.join(args.output, f"{template}.info")
+        save_info(output_path, template_results)
+        print(f"Information saved to {output_path}")
+        if store is not None:
+            store.append(args.model, template, template_results, args.ablation,
+                args.store_log_probs)
@@ -0,0 +1,159 @@
+import sys, os
+import json
+import argparse
+import numpy as np
+import torch
+
+import data
+from tqdm import tqdm
+from predict import load_model, cached_warm_up, read_tasks,\
+    add_evaluation_arguments, WarmUpCache, checkpoint_hash
+from tasks import sentence_batches
+
+# Values that can be recorded: the hidden and cell state, and the gates as
+# named by lstm.LSTMCell
+VALUES = ["hidden", "cell", "in", "forget", "out", "c_tilde"]
+
+
+class ActivationRecorder(object):
+    """
+    Stores the activations of chosen units at every token of every sentence
+    of a task in memory-mapped .npy files, one [tokens, units] array per value
+    in a directory. The activations of token t of sentence i are in row
+    offsets[i] + t, where offsets, subject_index, verb_index and numbers are
+    saved with them, so that e.g. all subjects are rows
+    offsets[:-1] + subject_index. Only the rows of a batch pass through memory.
+    """
+
+    def __init__(self, directory, task, units, nhid, values=VALUES,
+            dtype=np.float32):
+        """
+        Args:
+            directory (str): output directory, created if needed
+            task (dict): output of tasks.encode_task
+            units (list): unit numbers, counting on from layer 0 into layer 1
+            nhid (int): number of units per layer
+            values (list): which of VALUES to record
+            dtype (np.dtype): np.float32, or np.float16 to halve the size
+        """
+        self.directory = directory
+        self.offsets = np.asarray(task["offsets"])
+        self.values = list(values)
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+
+        # For every layer, the columns of the arrays and of the layer
+        self.columns = {}
+        for i, u in enumerate(units):
+            layer, column = divmod(u, nhid)
+            self.columns.setdefault(layer, ([], []))
+            self.columns[layer][0].append(i)
+            self.columns[layer][1].append(column)
+        self.columns = {l: (np.array(a), torch.tensor(c))
+            for l, (a, c) in self.columns.items()}
+
+        self.arrays = {v: np.lib.format.open_memmap(
+                os.path.join(directory, f"{v}.npy"), mode="w+", dtype=dtype,
+                shape=(int(self.offsets[-1]), len(units)))
+            for v in self.values}
+
+        for k in ["offsets", "subject_index", "verb_index", "numbers"]:
+            np.save(os.path.join(directory, f"{k}.npy"), np.asarray(task[k]))
+        with open(os.path.join(directory, "meta.json"), "w") as f:
+            json.dump({"units": [int(u) for u in units], "values": self.values,
+                "dtype": np.dtype(dtype).name}, f)
+
+    def hook(self, rows):
+        """
+        Returns:
+            function: hook for lstm.forward that writes the activations of a
+                      batch of whole sentences (the rows of the task)
+        """
+        starts = self.offsets[rows, None]
+
+        def record(step, layer, hidden, gates):
+            if layer not in self.columns:
+                return
+            array_columns, layer_columns = self.columns[layer]
+            layer_columns = layer_columns.to(hidden[0].device)
+            activations = dict(gates, hidden=hidden[0], cell=hidden[1])
+            for v in self.values:
+                self.arrays[v][starts + step, array_columns] =\
+                    activations[v][:, layer_columns].cpu().numpy()
+
+        return record
+
+    def flush(self):
+        for array in self.arrays.values():
+            array.flush()
+
+
+def load_activations(directory):
+    """
+    Returns:
+        dict: memory-mapped arrays saved by ActivationRecorder, by name
+        dict: units, values and dtype of the recording
+    """
+    with open(os.path.join(directory, "meta.json")) as f:
+        meta = json.load(f)
+    arrays = {k: np.load(os.path.join(directory, f"{k}.npy"), mmap_mode="r")
+        for k in meta["values"] + ["offsets", "subject_index", "verb_index",
+            "numbers"]}
+    return arrays, meta
+
+
+def record_activations(task, model, init_h, recorder, cuda, batch_size=64):
+    # Feed every sentence as a whole, up to and including the verb
+    with torch.no_grad():
+        for rows, input in tqdm(sentence_batches(task, batch_size)):
+            input = torch.from_numpy(input)
+            if cuda:
+                input = input.cuda()
+            hidden = tuple(h.expand(-1, len(rows), -1).contiguous() for h in init_h)
+            model.rnn_forward(input, hidden, record=False,
+                hook=recorder.hook(rows))
+    recorder.flush()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-m", "--model", type=str, default="models/model.pt",
+        help="Model (meta file) to use")
+    parser.add_argument("-i", "--input", type=str, nargs="+", required=True,
+        help="Input sentences (tsv files or directories of tsv files)")
+    parser.add_argument("-o", "--output", type=str, default="activations",
+        help="Output directory, with a subdirectory per template")
+    parser.add_argument("-u", "--units", type=int, nargs="+", default=None,
+        help="Units to record (default: all units of all layers)")
+    parser.add_argument("--values", type=str, nargs="+", default=VALUES,
+        choices=VALUES, help="Activations to record")
+    parser.add_argument("--float16", action="store_true", default=False,
+        help="Store activations as float16 instead of float32")
+    add_evaluation_arguments(parser)
+    # Sentences are always fed in batches here
+    parser.set_defaults(batch_size=64)
+    args = parser.parse_args()
+
+    vocab = data.Dictionary(args.vocabulary)
+    tasks = read_tasks(args.input, vocab, args.unk)
+    model = load_model(args.model, args.cuda)
+
+    cache = None
+    if args.warm_up_cache:
+        cache = WarmUpCache(checkpoint_hash(args.model), args.warm_up_cache)
+    init_h = cached_warm_up(model, vocab, args.cuda,
+        " ".join([f". {args.eos}"] * 5), cache)
+
+    units = args.units
+    if units is None:
+        units = list(range(model.nhid * model.nlayers))
+    if not all(model.nhid * model.nlayers > u >= 0 for u in units):
+        sys.exit("Invalid unit number")
+
+    for template, _, task in tasks:
+        directory = os.path.join(args.output, template)
+        print(f"Recording {template} in {directory}")
+        recorder = ActivationRecorder(directory, task, units, model.nhid,
+            args.values, np.float16 if args.float16 else np.float32)
+        record_activations(task, model, init_h, recorder, args.cuda,
+            args.batch_size)
@@ -1,27 +1,140 @@
 import os
 import torch
+import numpy as np
 
 class Dictionary(object):
+    """
+    Vocabulary with word2idx and idx2word, backed by a sorted string table so
+    that it can be saved to and loaded from a binary index (<path>.npz next to
+    the vocabulary file). The dict and list are only built when they are used;
+    encode and decode work on the index directly.
+    """
+
     def __init__(self, path=None):
-        self.word2idx = {}
-        self.idx2word = []
+        self._word2idx = {}
+        self._idx2word = []
+        # Sorted words and their indices, and the words in index order
+        self._index = None
+        self._words = None
         if path:
             self.load(path)
 
+    @property
+    def idx2word(self):
+        if self._idx2word is None:
+            self._idx2word = self.words.tolist()
+        return self._idx2word
+
+    @property
+    def word2idx(self):
+        if self._word2idx is None:
+            self._word2idx = {w: i for i, w in enumerate(self.idx2word)}
+        return self._word2idx
+
+    @property
+    def index(self):
+        """(words in sorted order, index of each of these words)"""
+        if self._index is None:
+            words = np.array(self.idx2word, dtype=str)
+            order = np.argsort(words, kind="stable")
+            self._index = (words[order], order)
+        return self._index
+
+    @property
+    def words(self):
+        """All words as an array, in index order"""
+        if self._words is None:
+            sorted_words, order = self.index
+            self._words = np.empty_like(sorted_words)
+            self._words[order] = sorted_words
+        return self._words
+
     def add_word(self, word):
         if word not in self.word2idx:
             self.idx2word.append(word)
             self.word2idx[word] = len(self.idx2word) - 1
+            self._index, self._words = None, None
         return self.word2idx[word]
 
     def __len__(self):
-        return len(self.idx2word)
+        if self._idx2word is None:
+            return len(self._index[1])
+        return len(self._idx2word)
+
+    def encode(self, tokens, unk=None):
+        """
+        Args:
+            tokens (list): words to look up
+            unk (str): word for tokens not in the vocabulary; if None, unknown
+                       tokens raise a KeyError
+        Returns:
+            np.ndarray: int64 index of every token
+        """
+        sorted_words, order = self.index
+        tokens = np.asarray(tokens, dtype=str)
+        if len(sorted_words) == 0:
+            raise KeyError("Empty vocabulary")
+
+        positions = np.searchsorted(sorted_words, tokens).clip(0,
+            len(sorted_words) - 1)
+        found = sorted_words[positions] == tokens
+        ids = order[positions].astype(np.int64)
+
+        if not found.all():
+            if unk is None:
+                raise KeyError(str(tokens[~found][0]))
+            ids[~found] = self.encode([unk])[0]
+        return ids
+
+    def decode(self, ids):
+        """
+        Args:
+            ids (array-like): word indices
+        Returns:
+            list: the word of every index
+        """
+        return self.words[np.asarray(ids, dtype=np.int64)].tolist()
+
+    def load(self, path, cache=True):
+        """
+        Read a vocabulary file, one word per line. Unless cache is False, the
+        words are read from the binary index <path>.npz if it was made from
+        the same file, and the index is written otherwise.
+        """
+        cache_path = f"{path}.npz"
+        stat = os.stat(path)
+        # The index only describes the file if no words were added before
+        cache = cache and len(self) == 0
+
+        if cache and os.path.exists(cache_path):
+            try:
+                with np.load(cache_path) as f:
+                    if f["size"] == stat.st_size and f["mtime_ns"] == stat.st_mtime_ns:
+                        self._index = (f["sorted_words"], f["order"])
+                        self._word2idx, self._idx2word, self._words = None, None, None
+                        return
+            except (OSError, ValueError, KeyError):
+                pass
 
-    def load(self, path):
         with open(path, "r") as f:
             for line in f:
                 self.add_word(line.rstrip("\n"))
 
+        if cache:
+            try:
+                self.save_index(cache_path, stat)
+            except OSError:
+                pass
+
+    def save_index(self, path, stat):
+        # Write to a temporary file first, other processes may be reading
+        sorted_words, order = self.index
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, "wb") as f:
+            np.savez(f, sorted_words=sorted_words, order=order,
+                size=stat.st_size, mtime_ns=stat.st_mtime_ns)
+        os.replace(tmp_path, path)
+
     def save(self, path):
         with open(path, "w") as f:
             for w in self.idx2word:
@@ -1,8 +1,99 @@
 import argparse
 import sys, os
 import random
-import csv, pandas
-import numpy as np
+import itertools
+
+
+def reservoir_sample(rows, condition, conditions, k, rng):
+    """
+    Reservoir sample up to k rows per number condition in a single pass, so
+    that memory does not depend on the number of rows.
+
+    Args:
+        rows (iterable): rows of any kind
+        condition (function): gives the condition of a row
+        conditions (list): conditions to sample, other rows are skipped
+        k (int): maximum number of rows to keep per condition
+        rng (random.Random): random number generator used for sampling
+    Returns:
+        reservoirs (dict): for each condition, the sampled rows
+        counts (dict): for each condition, the number of rows seen
+    """
+    reservoirs = {c: [] for c in conditions}
+    counts = {c: 0 for c in conditions}
+
+    for row in rows:
+        c = condition(row)
+        if c not in reservoirs:
+            continue
+        counts[c] += 1
+        reservoir = reservoirs[c]
+        if len(reservoir) < k:
+            reservoir.append(row)
+        else:
+            # Keep the row with probability k / rows seen so far
+            j = rng.randrange(counts[c])
+            if j < k:
+                reservoir[j] = row
+
+    return reservoirs, counts
+
+
+def balanced_sample(reservoirs, counts, k, rng):
+    """
+    Make sure the dataset is balanced, i.e. same amount for each condition.
+    A random subset of a reservoir is still a uniform sample of its condition.
+
+    Args:
+        reservoirs (dict): output of reservoir_sample
+        counts (dict): output of reservoir_sample
+        k (int): maximum number of rows per condition
+        rng (random.Random): random number generator used for sampling
+    Returns:
+        list: the same number of rows for every condition, in condition order
+        int: number of rows per condition
+    """
+    max_allowed_per_condition = min(min(k, n) for n in counts.values())
+    sampled = []
+    for reservoir in reservoirs.values():
+        sampled.extend(rng.sample(reservoir, max_allowed_per_condition))
+    return sampled, max_allowed_per_condition
+
+
+def sample_conditions(path, k, rng):
+    """
+    Reservoir sample up to k sentences per number condition in a single pass
+    over a tsv file of generated data, without loading the file in memory.
+
+    Args:
+        path (str): tsv file generated with generate_tasks.py
+        k (int): maximum number of sentences to keep per condition
+        rng (random.Random): random number generator used for sampling
+    Returns:
+        header (str): header line of the file
+        reservoirs (dict): for each combination of grammatical numbers, e.g.
+                           ("singular", "plural"), the sampled lines
+        counts (dict): for each combination, the number of lines in the file
+    """
+    with open(path) as f:
+        header = f.readline()
+        columns = header.rstrip("\n").split("\t")
+        number_columns = [i for i, col in enumerate(columns) if "number" in col]
+        # Not tracking more than 3 nouns
+        if not 1 <= len(number_columns) <= 3:
+            sys.exit("Number of conditions is incorrect. Please check the template.")
+
+        options = ["singular", "plural"]
+        conditions = list(itertools.product(options, repeat=len(number_columns)))
+
+        def condition(line):
+            values = line.rstrip("\n").split("\t")
+            return tuple(values[i] for i in number_columns)
+
+        reservoirs, counts = reservoir_sample(f, condition, conditions, k, rng)
+
+    return header, reservoirs, counts
+
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
@@ -10,6 +101,8 @@ if __name__ == "__main__":
     parser.add_argument("-d", "--directory", type=str, default="full_data")
     parser.add_argument("-o", "--output", type=str, default="tasks")
     parser.add_argument("-n", "--number", type=int, default=600)
+    parser.add_argument("-s", "--seed", type=int, default=None,
+        help="Random seed for sampling sentences (default: not reproducible)")
     args = parser.parse_args()
 
     path = f"{args.directory}/{args.template}.tsv"
@@ -21,61 +114,16 @@ if __name__ == "__main__":
     if not os.path.exists(args.output):
         os.makedirs(args.output)
 
-    # Load data and convert all integers to strings
-    data = pandas.read_csv(path, sep="\t", header=0).applymap(str)
-    header = data.columns.values
-    nums = sum("number" in col for col in header)
-
-    separated_conditions, amounts = [], []
-    options = ["singular", "plural"]
-
-    # First separate all conditions in a list by filtering on each combination
-    # of grammatical numbers
-
-    # E.g., simple, qnty_simple, namepp
-    if nums == 1:
-        for num1 in options:
-            curr_condition = data.loc[data["number1"] == num1]
-            separated_conditions.append(curr_condition)
-            amounts.append(min(args.number, len(curr_condition)))
-
-    # E.g., nounpp, that
-    elif nums == 2:
-        for num1 in options:
-            for num2 in options:
-                curr_condition = data.loc[(data["number1"] == num1) &\
-                                    (data["number2"] == num2)]
-                separated_conditions.append(curr_condition)
-                amounts.append(min(args.number, len(curr_condition)))
-
-    # E.g., that_nounpp
-    elif nums == 3:
-        for num1 in options:
-            for num2 in options:
-                for num3 in options:
-                    curr_condition = data.loc[(data["number1"] == num1) &\
-                                        (data["number2"] == num2) &\
-                                        (data["number3"] == num3)]
-                    separated_conditions.append(curr_condition)
-                    amounts.append(min(args.number, len(curr_condition)))
-
-    else:
-        sys.exit("Number of conditions is incorrect. Please check the template.")
-
-    # Make sure the dataset is balanced, i.e. same amount for each condition
-    max_allowed_per_condition = min(amounts)
-    header = list(data)
-
     # For sentence sampling
-    random.seed()
+    rng = random.Random(args.seed)
+    header, reservoirs, counts = sample_conditions(path, args.number, rng)
 
-    with open(os.path.join(args.output, f"{args.template}.tsv"), "w") as f:
-        f.write("\t".join(header) + "\n")
-        for c in separated_conditions:
-            sentences = c.values.tolist()
-            sampled = random.sample(sentences, max_allowed_per_condition)
+    sampled, max_allowed_per_condition = balanced_sample(reservoirs, counts,
+        args.number, rng)
 
-            for s in sampled:
-                f.write("\t".join(s) + "\n")
+    with open(os.path.join(args.output, f"{args.template}.tsv"), "w") as f:
+        f.write(header)
+        for line in sampled:
+            f.write(line)
 
     print(f"Sampled {max_allowed_per_condition} sentences per condition")
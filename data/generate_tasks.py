@@ -1,13 +1,17 @@
 import os, sys
 import csv
 import random
+import shutil
 import argparse
+import multiprocessing
 
 from collections import defaultdict
-from nltk.parse.generate import generate
+from itertools import zip_longest
 from tqdm import tqdm
 
-from grammar import get_grammar, get_grammar_string
+from grammar import TEMPLATES, generate_sentences, get_grammar_string
+
+ABBREVIATIONS = {"sg": "singular", "pl": "plural"}
 
 def read_words(filename, n=-1):
     """
@@ -38,6 +42,12 @@ def generate_dataset(grammar, correct, incorrect):
     """
     Generate data with correct and incorrect number-verb agreement.
 
+    The sentences of every number condition are produced directly from its
+    start symbol rules, so no parsing is needed to label them. The correct and
+    incorrect rule of a condition only differ in the number of the verb and
+    are expanded in the same order, which pairs every sentence with its
+    counterpart.
+
     Args:
         grammar (str): NLTK feature grammar
         correct (dict): for each number condition (key) a start symbol rule
@@ -45,51 +55,24 @@ def generate_dataset(grammar, correct, incorrect):
         incorrect (dict): for each number condition (key) a start symbol rule
                         (value) to create sentences with incorrect verb number
 
-    Returns:
-        data_correct (list): tuples of (sentence, number_condition) for all
-                            correct sentences
-        data_incorrect (list): tuples of (sentence, number_condition) for all
-                            sentences with number-verb disagreement
+    Yields:
+        tuple: (correct sentence, incorrect sentence, number_condition), one
+               at a time so that the dataset never has to fit in memory
     """
-    n_conditions = len(list(correct.keys())[0].split("_"))
-    # Tasks that only have one noun of which we are tracking the number
-    # Examples: simple, adv, qnty_simple, namepp
-    if n_conditions == 1:
-        grammar_correct, _ = get_grammar(grammar, correct["sg"])
-    # Tasks that have two nouns of which we are tracking the number
-    # Examples: nounpp
-    elif n_conditions == 2:
-        grammar_correct, _ = get_grammar(grammar, correct["sg_sg"])
-    elif n_conditions == 3:
-        grammar_correct, _ = get_grammar(grammar, correct["sg_sg_sg"])
     # Not tracking more than 3 nouns
-    else:
+    n_conditions = len(list(correct.keys())[0].split("_"))
+    if n_conditions > 3:
         sys.exit("Number of conditions is incorrect. Please check the template.")
 
-    correct_parsers = defaultdict()
-    incorrect_parsers = defaultdict()
-    data_correct, data_incorrect = [], []
-
     # 'corect' and 'incorrect' are dictionaries containing the same keys
-    # Get the parsers for both the correct sentences and the incorrect
-    # sentences, where the verb number does not match the noun number
-    for corr_key, incorr_key in zip(correct, incorrect):
-        _, correct_parsers[corr_key] = get_grammar(grammar, correct[corr_key])
-        _, incorrect_parsers[incorr_key] = get_grammar(grammar, incorrect[incorr_key])
-
-    # Generate n sentences and classify as either correct or incorrect
-    for sent in tqdm(list(generate(grammar_correct, n=1000000))):
-        for key in correct_parsers:
-            # If a parser for correct sentence can parse the current sentence,
-            # the sentence is correct
-            if list(correct_parsers[key].parse(sent)):
-                data_correct.append((" ".join(sent), key))
-                break
-            elif list(incorrect_parsers[key].parse(sent)):
-                data_incorrect.append((" ".join(sent), key))
-                break
-
-    return data_correct, data_incorrect
+    for key in correct:
+        pairs = zip_longest(generate_sentences(grammar, correct[key]),
+            generate_sentences(grammar, incorrect[key]))
+        for corr, incorr in pairs:
+            if corr is None or incorr is None:
+                sys.exit(f"Condition {key} does not have as many correct as "
+                          "incorrect sentences. Please check the template.")
+            yield " ".join(corr), " ".join(incorr), key
 
 def post_process(sentence):
     """
@@ -118,13 +101,86 @@ def post_process(sentence):
     return incomplete, str(subject_index), str(verb_index), complete
 
 
-if __name__ == "__main__":
-    parser = argparse.ArgumentParser()
-    parser.add_argument("-t", "--template", type=str, required=True,
-                        help="The template of the output sentences.")
-    parser.add_argument("-o", "--output", type=str, default="full_data",
-                        help="Directory to store the full generated data.")
-    parser.add_argument("--sample", default=False)
+def get_header(n_conditions):
+    """
+    Args:
+        n_conditions (int): number of nouns of which the number is tracked
+    Returns:
+        str: header line of a task tsv file
+    """
+    n_num = "".join([f"\tnumber{i}" for i in range(1, n_conditions+1)])
+    return f"agreement\tdisagreement\tcorrect_verb\tincorrect_verb\t"\
+           f"subject_index\tverb_index{n_num}\tcompleted\n"
+
+
+def format_row(agr, disagr, condition):
+    """
+    Args:
+        agr (str): generated sentence with number-verb agreement
+        disagr (str): the same sentence with number-verb disagreement
+        condition (str): number condition, e.g. sg_pl
+    Returns:
+        str: line of a task tsv file
+    """
+    # Get both correct and incorrect version of the same sentence
+    agr, subject_idx, verb_idx, compl = post_process(agr)
+    disagr, _, _, _ = post_process(disagr)
+    corr_verb = agr.split()[int(verb_idx)]
+    incorr_verb = disagr.split()[int(verb_idx)]
+    # Turn "sg_sg" into ["singular", "singular"]
+    numbers = [ABBREVIATIONS[k] for k in condition.split("_")]
+    line = [agr, disagr, corr_verb, incorr_verb, subject_idx, verb_idx]\
+           + numbers + [compl]
+    return "\t".join(line) + "\n"
+
+
+def write_dataset(rows, filename, header=None, flush_every=10000,
+        progress=True):
+    """
+    Write generated sentences to a tsv file as they are produced.
+
+    Args:
+        rows (iterable): tuples of (correct sentence, incorrect sentence,
+                         number_condition), such as made by generate_dataset
+        filename (str): output tsv file
+        header (str): header line to start the file with, if any
+        flush_every (int): number of rows after which the file is flushed
+        progress (bool): show the number of rows written so far
+    Returns:
+        int: number of rows written
+    """
+    n_rows = 0
+    with open(filename, 'w') as f:
+        if header is not None:
+            f.write(header)
+        for agr, disagr, condition in tqdm(rows, unit=" sentences",
+                disable=not progress):
+            f.write(format_row(agr, disagr, condition))
+            n_rows += 1
+            if n_rows % flush_every == 0:
+                f.flush()
+    return n_rows
+
+
+def generate_part(grammar, correct, incorrect, filename):
+    """
+    Entry point of a worker process: write the sentences of the start rules
+    to a part file without a header, to be concatenated by the main process.
+
+    Args:
+        grammar (str): NLTK feature grammar
+        correct (dict): start symbol rules for the correct sentences
+        incorrect (dict): start symbol rules for the incorrect sentences
+        filename (str): output part file
+    Returns:
+        int: number of rows written
+    """
+    rows = generate_dataset(grammar, correct, incorrect)
+    return write_dataset(rows, filename, progress=False)
+
+
+def add_vocabulary_arguments(parser):
+    # Arguments shared by generate_tasks.py and predict_generated.py
     parser.add_argument("--adverbs1_num", type=int, default=-1,
                         help="Maximum number of adverbs to use.")
     parser.add_argument("--position_nouns_num", type=int, default=-1,
@@ -141,64 +197,92 @@ if __name__ == "__main__":
                         help="Maximum number of nouns to use for quantity pairs.")
     parser.add_argument("--object_nouns_num", type=int, default=-1,
                         help="Maximum number of object nouns to use.")
+
+
+def read_vocabulary(args, directory="vocabulary"):
+    """
+    Read the vocabulary from the csv files, sampling as many words as the
+    --*_num arguments allow.
+
+    Args:
+        args (argparse.Namespace): parsed add_vocabulary_arguments
+        directory (str): directory containing the csv files
+    Returns:
+        dict: word columns by the matching argument of get_grammar_string
+    """
+    vocabulary = {}
+    for name, filename, n in [
+            ("adverbs", "adverbs1.csv", args.adverbs1_num),
+            ("conjunctions", "conjunctions.csv", -1),
+            ("object_nouns", "object_nouns.csv", args.object_nouns_num),
+            ("position_nouns", "position_nouns.csv", args.position_nouns_num),
+            ("prepositions", "prepositions.csv", args.prepositions_num),
+            ("proper_nouns", "proper_nouns.csv", args.proper_nouns_num),
+            ("subject_nouns", "subject_nouns.csv", args.subject_nouns_num),
+            ("quantity_nouns", "quantity_nouns.csv", -1),
+            ("quantity_subject_nouns", "quantity_subject_nouns.csv",
+                args.qnty_nouns_num),
+            ("relative_pronouns", "relative_pronouns.csv", -1),
+            ("verbs_trans", "verbs_transitive.csv", args.verbs_num),
+            ("verbs_intrans", "verbs_intransitive.csv", args.verbs_num),
+            ("verbs_modal", "verbs_modal.csv", -1)]:
+        vocabulary[name] = read_words(os.path.join(directory, filename), n)
+    return vocabulary
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-t", "--template", type=str, nargs="+", required=True,
+                        help="The templates of the output sentences, or 'all'.")
+    parser.add_argument("-o", "--output", type=str, default="full_data",
+                        help="Directory to store the full generated data.")
+    parser.add_argument("-w", "--workers", type=int, default=1,
+                        help="Number of processes to spread the templates and "
+                        "their number conditions over.")
+    parser.add_argument("--sample", default=False)
+    add_vocabulary_arguments(parser)
     args = parser.parse_args()
 
-    # Read the vocabulary from the csv files
-    adverbs = read_words("vocabulary/adverbs1.csv", args.adverbs1_num)
-    conjunctions = read_words("vocabulary/conjunctions.csv")
-    object_nouns = read_words("vocabulary/object_nouns.csv",
-        args.object_nouns_num)
-    position_nouns = read_words("vocabulary/position_nouns.csv",
-        args.position_nouns_num)
-    prepositions = read_words("vocabulary/prepositions.csv",
-        args.prepositions_num)
-    proper_nouns = read_words("vocabulary/proper_nouns.csv",
-        args.proper_nouns_num)
-    subject_nouns = read_words("vocabulary/subject_nouns.csv",
-        args.subject_nouns_num)
-    quantity_nouns = read_words("vocabulary/quantity_nouns.csv")
-    quantity_subject_nouns = read_words("vocabulary/quantity_subject_nouns.csv",
-        args.qnty_nouns_num)
-    relative_pronouns = read_words("vocabulary/relative_pronouns.csv")
-    verbs_trans = read_words("vocabulary/verbs_transitive.csv",
-        args.verbs_num)
-    verbs_intrans = read_words("vocabulary/verbs_intransitive.csv",
-        args.verbs_num)
-    verbs_modal = read_words("vocabulary/verbs_modal.csv")
+    templates = TEMPLATES if args.template == ["all"] else args.template
+
+    # The vocabulary is read (and sampled) once, for all templates
+    vocabulary = read_vocabulary(args)
 
     output_dir = args.output
     if not os.path.exists(output_dir):
         os.makedirs(output_dir)
-    filename = f"{args.template}.tsv"
-
-    abbreviations = {"sg":"singular", "pl": "plural"}
 
     print("Generating data and evaluating. This may take a while.")
-    grammar, correct, incorrect = get_grammar_string(args.template, verbs_trans,
-        verbs_intrans, subject_nouns, object_nouns, position_nouns, prepositions,
-        adverbs, proper_nouns, quantity_nouns, quantity_subject_nouns,
-        relative_pronouns, conjunctions, verbs_modal)
-
-    data_correct, data_incorrect = generate_dataset(grammar, correct, incorrect)
-
-    # Data comes in a tuple, with the second element indicating the condition,
-    # e.g. sg_sg, which gives n_num = 2
-    n_num = len(data_correct[0][1].split("_"))
-    n_num = "".join([f"\tnumber{i}" for i in range(1,n_num+1)])
-    header = f"agreement\tdisagreement\tcorrect_verb\tincorrect_verb\t"\
-             f"subject_index\tverb_index{n_num}\tcompleted\n"
-
-    with open(os.path.join(output_dir, filename), 'w') as f:
-        f.write(header)
-        for (agr, num1), (disagr, num2) in zip(data_correct, data_incorrect):
-            assert num1 == num2
-            # Get both correct and incorrect version of the same sentence
-            agr, subject_idx, verb_idx, compl = post_process(agr)
-            disagr, _, _, _ = post_process(disagr)
-            corr_verb = agr.split()[int(verb_idx)]
-            incorr_verb = disagr.split()[int(verb_idx)]
-            # Turn "sg_sg" into ["singular", "singular"]
-            numbers = [abbreviations[k] for k in num1.split("_")]
-            line = [agr, disagr, corr_verb, incorr_verb, subject_idx, verb_idx]\
-                   + numbers + [compl]
-            f.write("\t".join(line) + "\n")
+    grammars = {t: get_grammar_string(t, **vocabulary) for t in templates}
+
+    if args.workers > 1:
+        # One job per template and number condition, each writing to its own
+        # part file; the parts are concatenated in order afterwards
+        jobs = [(grammar, {key: correct[key]}, {key: incorrect[key]},
+                os.path.join(output_dir, f"{template}.{key}.part"))
+            for template, (grammar, correct, incorrect) in grammars.items()
+            for key in correct]
+        with multiprocessing.Pool(args.workers) as pool:
+            n_rows = pool.starmap(generate_part, jobs)
+        n_rows = dict(zip([job[-1] for job in jobs], n_rows))
+
+    for template, (grammar, correct, incorrect) in grammars.items():
+        filename = os.path.join(output_dir, f"{template}.tsv")
+        # Number conditions look like sg_sg, which gives 2 conditions
+        header = get_header(len(list(correct.keys())[0].split("_")))
+
+        if args.workers > 1:
+            parts = [os.path.join(output_dir, f"{template}.{key}.part")
+                for key in correct]
+            with open(filename, "w") as f:
+                f.write(header)
+                for part in parts:
+                    with open(part) as part_file:
+                        shutil.copyfileobj(part_file, f)
+                    os.remove(part)
+            template_rows = sum(n_rows[part] for part in parts)
+        else:
+            rows = generate_dataset(grammar, correct, incorrect)
+            template_rows = write_dataset(rows, filename, header)
+
+        print(f"Wrote {template_rows} sentences to {filename}")
@@ -1,7 +1,16 @@
 from collections import defaultdict
-import nltk
+import itertools
+import re
 import sys
 
+# Templates known to get_grammar_string
+TEMPLATES = ["simple", "adv", "namepp", "qnty_simple", "qnty_namepp", "nounpp",
+    "qnty_nounpp", "that_trans", "that_simple", "that_adv", "that_nounpp",
+    "noun_conj", "s_conj", "rel_def", "rel_nondef", "rel_def_obj"]
+
+# A terminal such as 'de meid' or a nonterminal such as NP[AGR='sg']
+SYMBOL = re.compile(r"'[^']*'|\w+(?:\[[^\]]*\])?")
+
 def get_grammar(start, grammar):
     """
     Generate a grammar and parser givven a starting symbol rule.
@@ -11,6 +20,9 @@ def get_grammar(start, grammar):
         g (nltk.grammar.FeatureGrammar): grammar in string, one rule per line
         p (nltk.parse.FeatureEarleyChartParser): parser created from grammar
     """
+    # Only needed for parsing, generating sentences does not use nltk
+    import nltk
+
     g = f"% start S\n{start}\n{grammar}"
     g = nltk.grammar.FeatureGrammar.fromstring(g)
     p = nltk.parse.FeatureEarleyChartParser(g)
@@ -18,6 +30,135 @@ def get_grammar(start, grammar):
     return g, p
 
 
+def parse_symbol(symbol):
+    """
+    Args:
+        symbol (str): terminal ('de meid') or nonterminal (NP[AGR='sg'])
+    Returns:
+        tuple: (word, None) for a terminal, (name, {feature: value}) for a
+               nonterminal, with the quotes removed from the values
+    """
+    if symbol.startswith("'"):
+        return symbol[1:-1], None
+    name, _, features = symbol.partition("[")
+    features = [f.split("=") for f in features.rstrip("]").split(",") if f]
+    return name, {k.strip(): v.strip().strip("'") for k, v in features}
+
+
+def parse_rules(grammar):
+    """
+    Read the productions of a feature grammar such as the one made by
+    get_grammar_string.
+    Args:
+        grammar (str): one rule per line, alternatives separated by |
+    Returns:
+        dict: {nonterminal: [(features of the left-hand side, [symbols])]}
+    """
+    rules = defaultdict(list)
+    for line in grammar.splitlines():
+        if "->" not in line:
+            continue
+        lhs, rhs = line.split("->", 1)
+        name, features = parse_symbol(lhs.strip())
+        for alternative in rhs.split("|"):
+            rules[name].append((features,
+                [parse_symbol(s) for s in SYMBOL.findall(alternative)]))
+    return rules
+
+
+def unify(lhs_features, features):
+    """
+    Returns:
+        dict: values bound to the variables (?a) of the left-hand side, or None
+              if the features of the symbol and the rule do not agree
+    """
+    bindings = {}
+    for k, v in features.items():
+        rule_v = lhs_features.get(k)
+        if rule_v is None or v.startswith("?"):
+            continue
+        if rule_v.startswith("?"):
+            if bindings.setdefault(rule_v, v) != v:
+                return None
+        elif rule_v != v:
+            return None
+    return bindings
+
+
+def expand(rules, symbol, values):
+    """
+    Generate every sentence a symbol produces, without parsing: only rules
+    whose features agree with those of the symbol are followed.
+    Args:
+        rules (dict): output of parse_rules
+        symbol (tuple): output of parse_symbol
+        values (dict): {feature: possible values}, for variables that are not
+                       bound by the symbol, e.g. in VP[AGR=?a] -> V[AGR=?a]
+    Yields:
+        list: words of a sentence
+    """
+    name, features = symbol
+    if features is None:
+        yield [name]
+        return
+
+    for lhs_features, rhs in rules[name]:
+        bindings = unify(lhs_features, features)
+        if bindings is None:
+            continue
+
+        # A variable that is still free takes every possible value in turn,
+        # so that all symbols of the rule that share it still agree
+        free = {}
+        for _, f in rhs:
+            for k, v in (f or {}).items():
+                if v.startswith("?") and v not in bindings:
+                    free[v] = values[k]
+
+        for assignment in itertools.product(*free.values()):
+            bound = dict(bindings, **dict(zip(free, assignment)))
+            children = [(n, None if f is None else
+                    {k: bound.get(v, v) for k, v in f.items()})
+                for n, f in rhs]
+            yield from expand_sequence(rules, children, values)
+
+
+def expand_sequence(rules, symbols, values):
+    """
+    Generate every sentence a sequence of symbols produces. The expansions of
+    later symbols are generated again for every expansion of the first one,
+    so memory does not grow with the number of sentences.
+    Yields:
+        list: words of a sentence
+    """
+    if not symbols:
+        yield []
+        return
+    for head in expand(rules, symbols[0], values):
+        for tail in expand_sequence(rules, symbols[1:], values):
+            yield head + tail
+
+
+def generate_sentences(grammar, start):
+    """
+    Args:
+        grammar (str): feature grammar made by get_grammar_string
+        start (str): start symbol rule, such as S -> NP[AGR=sg] VP[AGR=sg]
+    Yields:
+        list: words of every sentence the start rule produces
+    """
+    rules = parse_rules(f"{start}\n{grammar}")
+    values = defaultdict(set)
+    for productions in rules.values():
+        for lhs_features, _ in productions:
+            for k, v in (lhs_features or {}).items():
+                if not v.startswith("?"):
+                    values[k].add(v)
+    values = {k: sorted(v) for k, v in values.items()}
+
+    yield from expand(rules, ("S", {}), values)
+
+
 def get_opposite_number(grammatical_number):
     """
     Args:
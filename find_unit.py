@@ -1,67 +1,62 @@
-import pickle
 import argparse
 import pandas as pd
+from results import read_results, conditions, ResultsStore
 pd.options.display.max_rows = 1500
 
 
-def read_results(filename):
-    try:
-        with open(filename, "rb") as f:
-            data = pickle.load(f)
-            return data
-    except:
-        print(f"{filename} is not readable.")
+def accuracy_table(data):
+    """
+    Args:
+        data (dict): {unit: output of categorise_predictions}, as in an .info
+                     file written by ablation.py with --sweep
+    Returns:
+        pandas.DataFrame: accuracy per unit (rows) and condition (columns)
+    """
+    # Skip the keys of an unablated run stored in the same file
+    return pd.DataFrame.from_dict({k: {c: res[f"accuracy_{c}"]
+        for c in conditions(res)} for k, res in data.items()
+        if isinstance(res, dict)}, orient="index")
+
+
+def short_names(df):
+    # singular_plural -> SP
+    return df.rename(columns=lambda c: "".join(n[0].upper() for n in c.split("_")))
+
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument("-i", "--input", type=str,
         help="Path to file")
+    parser.add_argument("--results_db", type=str, default=None,
+        help="Read the results of the template in --input from this database "
+        "instead of the .info file")
+    parser.add_argument("-m", "--model", type=str, default="models/model.pt",
+        help="Model whose results are read from --results_db")
+    parser.add_argument("--ablation", type=str, default="recurrent",
+        help="Kind of ablation whose results are read from --results_db")
     args = parser.parse_args()
 
-    data = read_results(args.input)
+    if args.results_db:
+        template = args.input.split("/")[-1].replace(".info", "")
+        df = ResultsStore(args.results_db).table(template=template,
+            model=args.model, ablation=args.ablation)
+        df = df.loc[template].drop(columns="all", errors="ignore")
+        df = df.rename_axis(index=None, columns=None)
+    else:
+        df = accuracy_table(read_results(args.input))
+    df = short_names(df)
 
     if "that_nounpp" in args.input:
-        df = pd.DataFrame(columns=["SSS", "SSP", "SPS", "SPP", "PSS", "PSP", "PPS", "PPP"])
-
+        df = df[["SSS", "SSP", "SPS", "SPP", "PSS", "PSP", "PPS", "PPP"]]
         df.loc["-1"] = [0.998, 0.985, 1.0, 1.0, 1.0, 0.993, 1.0, 1.0]
 
-        for k in list(data):
-            column_data = []
-            res = data[k]
-            for x in ["singular", "plural"]:
-                for y in ["singular", "plural"]:
-                    for z in ["singular", "plural"]:
-                        column_data.append(res[f"accuracy_{x}_{y}_{z}"])
-
-            df.loc[k] = column_data[:8]
-
         print(df.loc[["-1"]])
-        diff = df.loc[(df["SSS"] <= (df.loc["-1"]["SSS"] - 0.08))
-                    | (df["SSP"] <= (df.loc["-1"]["SSP"] - 0.08))
-                    | (df["SPS"] <= (df.loc["-1"]["SPS"] - 0.08))
-                    | (df["SPP"] <= (df.loc["-1"]["SPP"] - 0.08))
-                    | (df["PSS"] <= (df.loc["-1"]["PSS"] - 0.08))
-                    | (df["PSP"] <= (df.loc["-1"]["PSP"] - 0.08))
-                    | (df["PPS"] <= (df.loc["-1"]["PPS"] - 0.08))
-                    | (df["PPP"] <= (df.loc["-1"]["PPP"] - 0.08))
-                    ]
+        diff = df.loc[(df <= (df.loc["-1"] - 0.08)).any(axis=1)]
 
     elif "nounpp" in args.input:
-        df = pd.DataFrame(columns=["SS", "SP", "PS", "PP"])
-        for k in list(data):
-            res = data[k]
-            c1 = res["accuracy_singular_singular"]
-            c2 = res["accuracy_singular_plural"]
-            c3 = res["accuracy_plural_singular"]
-            c4 = res["accuracy_plural_plural"]
-            df.loc[k] = [c1, c2, c3, c4]
-
+        df = df[["SS", "SP", "PS", "PP"]]
         df.loc["-1"] = [0.9983, 0.9783, 0.9467, 0.9450]
 
         print(df.loc[["-1"]])
-        diff = df.loc[(df["PS"] < (df.loc["-1"]["PS"] - 0.1))
-                    | (df["PP"] < (df.loc["-1"]["PP"] - 0.1))
-                    | (df["SP"] < (df.loc["-1"]["SP"] - 0.1))
-                    | (df["SS"] < (df.loc["-1"]["SS"] - 0.1))]
-        diff.append(df.loc["-1"])
+        diff = df.loc[(df < (df.loc["-1"] - 0.1)).any(axis=1)]
     print(diff)
@@ -1,67 +1,143 @@
 import torch
 import torch.nn.functional as F
-
-def LSTMCell(input, hidden, w_ih, w_hh, b_ih=None, b_hh=None):
-    hx, cx = hidden
+from typing import Optional, Tuple
+
+
+@torch.jit.script
+def fused_cell(input: torch.Tensor, hx: torch.Tensor, cx: torch.Tensor,
+        w_ih: torch.Tensor, w_hh: torch.Tensor, b_ih: Optional[torch.Tensor],
+        b_hh: Optional[torch.Tensor], inplace: bool) -> Tuple[torch.Tensor,
+        torch.Tensor, torch.Tensor, torch.Tensor, torch.Tensor, torch.Tensor]:
+    # Compiled version of the original cell. The activations are applied to
+    # the same four views of the gates as before, so the results are the same:
+    # applying them to other views (e.g. the input and forget gate at once) or
+    # concatenating w_ih and w_hh into one matmul changes the last bits.
     gates = F.linear(input, w_ih, b_ih) + F.linear(hx, w_hh, b_hh)
 
-    ingate, forgetgate, cy_tilde, outgate = gates.chunk(4, 1) #dim modified from 1 to 2
+    n = hx.size(1)
+    ingate, forgetgate, cy_tilde, outgate = [gates.narrow(1, i * n, n)
+        for i in range(4)]
 
-    ingate = F.sigmoid(ingate)
-    forgetgate = F.sigmoid(forgetgate)
-    cy_tilde = F.tanh(cy_tilde)
-    outgate = F.sigmoid(outgate)
+    # In place saves four allocations, but autograd needs the originals
+    if inplace:
+        ingate = ingate.sigmoid_()
+        forgetgate = forgetgate.sigmoid_()
+        cy_tilde = cy_tilde.tanh_()
+        outgate = outgate.sigmoid_()
+    else:
+        ingate = torch.sigmoid(ingate)
+        forgetgate = torch.sigmoid(forgetgate)
+        cy_tilde = torch.tanh(cy_tilde)
+        outgate = torch.sigmoid(outgate)
 
     cy = (forgetgate * cx) + (ingate * cy_tilde)
-    hy = outgate * F.tanh(cy)
+    hy = outgate * torch.tanh(cy)
+
+    return hy, cy, ingate, forgetgate, cy_tilde, outgate
+
+
+def LSTMCell(input, hidden, w_ih, w_hh, b_ih=None, b_hh=None,
+        recurrent_mask=None):
+    hx, cx = hidden
+    # masking hx only where it enters w_hh has the same effect as zeroing the
+    # corresponding columns of w_hh, but can differ per row of the batch
+    if recurrent_mask is not None:
+        hx = hx * recurrent_mask
+
+    hy, cy, ingate, forgetgate, cy_tilde, outgate =\
+        fused_cell(input, hx, cx, w_ih, w_hh, b_ih, b_hh,
+            not torch.is_grad_enabled())
 
     return (hy, cy), {'in': ingate, 'forget': forgetgate, 'out': outgate, 'c_tilde': cy_tilde}
 
 
+# mask can be [hidden] or [batch, hidden]: in the latter case every row of the
+# batch gets its own mask
 def apply_mask(hidden_l, mask):
     if type(hidden_l) == torch.autograd.Variable:
         return hidden_l * mask
     else:
         return tuple(h * mask for h in hidden_l)
 
-def forward(self, input, hidden, mask=None):
+def forward(self, input, hidden, mask=None, recurrent_mask=None,
+        output_mask=None, record=True, hook=None, first_layer=0):
+    """
+    input: [seq_len, batch, features], fed one step at a time
+    mask: {layer: mask} applied to the hidden state and output of a layer
+    recurrent_mask: {layer: mask} applied to the hidden state of a layer only
+        where it feeds back into the same layer, i.e. zeroing columns of w_hh
+    output_mask: mask applied to the output of the last layer, i.e. zeroing
+        columns of the decoder; the hidden state that is returned is unaffected
+    record: save the gates and hidden states of every layer at every step in
+        all_gates and all_hidden, and those of the last step in last_gates and
+        last_hidden; evaluation that does not read them can turn this off
+    hook: function called as hook(step, layer, (h, c), gates) for every layer
+        at every step, e.g. to store activations without keeping them all in
+        memory (see activations.py)
+    first_layer: only feed the layers from first_layer on; input is then the
+        output of the layer before it, e.g. computed once for several
+        ablations that do not change that layer (see predict.LayerCache). The
+        states of the layers that are skipped are returned as passed in
+    """
     num_layers = self.num_layers
     weight = self.all_weights
     dropout = self.dropout
     # saves the gate values into the rnn object
-    self.last_gates = []
-    self.last_hidden =[]
+    if record:
+        self.all_gates = []
+        self.all_hidden = []
 
-    next_hidden = []
+    # Nothing to feed, e.g. a sentence whose verb is its first word
+    if input.size(0) == 0:
+        return input.new_zeros(0, input.size(1), self.hidden_size), hidden
 
     hidden = list(zip(*hidden))
-
-    for l in range(num_layers):
-        hidden_l = hidden[l]
-        if mask and l in mask:
-            hidden_l = apply_mask(hidden_l, mask[l])
-        # we assume there is just one token in the input
-        hy, gates = LSTMCell(input[0], hidden_l, *weight[l])
-        if mask and l in mask:
-            hy = apply_mask(hy, mask[l])
-
-        self.last_gates.append(gates)
-        self.last_hidden.append(hy)
-        next_hidden.append(hy)
-
-        input = hy[0]
-
-        if dropout != 0 and l < num_layers - 1:
-            input = F.dropout(input, p=dropout, training=False, inplace=False)
-
-    next_h, next_c = zip(*next_hidden)
+    outputs = []
+
+    # every layer takes a [batch, features] input for one step at a time
+    for step in range(input.size(0)):
+        step_input = input[step]
+        step_gates, step_hidden = [None] * first_layer, [None] * first_layer
+
+        for l in range(first_layer, num_layers):
+            hidden_l = hidden[l]
+            if mask and l in mask:
+                hidden_l = apply_mask(hidden_l, mask[l])
+            hy, gates = LSTMCell(step_input, hidden_l, *weight[l],
+                recurrent_mask=recurrent_mask.get(l) if recurrent_mask else None)
+            if mask and l in mask:
+                hy = apply_mask(hy, mask[l])
+
+            if record:
+                step_gates.append(gates)
+                step_hidden.append(hy)
+            if hook is not None:
+                hook(step, l, hy, gates)
+            hidden[l] = hy
+
+            step_input = hy[0]
+
+            if dropout != 0 and l < num_layers - 1:
+                step_input = F.dropout(step_input, p=dropout, training=False,
+                    inplace=False)
+
+        if record:
+            self.all_gates.append(step_gates)
+            self.all_hidden.append(step_hidden)
+        outputs.append(step_input)
+
+    if record:
+        self.last_gates = self.all_gates[-1]
+        self.last_hidden = self.all_hidden[-1]
+
+    next_h, next_c = zip(*hidden)
     next_hidden = (
         torch.cat(next_h, 0).view(num_layers, *next_h[0].size()),
         torch.cat(next_c, 0).view(num_layers, *next_c[0].size())
     )
 
+    output = torch.stack(outputs, 0)
+    if output_mask is not None:
+        output = output * output_mask
 
-    # we restore the right dimensionality
-    input = input.unsqueeze(0)
-
-    return input, next_hidden
+    return output, next_hidden
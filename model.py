@@ -1,9 +1,14 @@
+import contextlib
+import torch
 import torch.nn as nn
 from torch.autograd import Variable
 
 class RNNModel(nn.Module):
     """Container module with an encoder, a recurrent module, and a decoder."""
 
+    # [nhid] mask of the decoder columns of ablated units, see ablate
+    decoder_mask = None
+
     def __init__(self, rnn_type, ntoken, ninp, nhid, nlayers, dropout=0.5, tie_weights=False):
         super(RNNModel, self).__init__()
         self.drop = nn.Dropout(dropout)
@@ -45,10 +50,114 @@ class RNNModel(nn.Module):
     def forward(self, input, hidden):
         emb = self.drop(self.encoder(input))
         output, hidden = self.rnn(emb, hidden)
-        output = self.drop(output)
+        output = self.mask_output(self.drop(output))
         decoded = self.decoder(output.view(output.size(0)*output.size(1), output.size(2)))
         return decoded.view(output.size(0), output.size(1), decoded.size(1)), hidden
 
+    def rnn_forward(self, input, hidden, first_layer=0, **kwargs):
+        """Same as forward, but stops before the decoder. Keyword arguments are
+        passed on to the (patched) recurrent module. With first_layer > 0 the
+        input is the output of the layer before it instead of words, see
+        lstm.forward."""
+        if first_layer > 0:
+            output, hidden = self.rnn(input, hidden, first_layer=first_layer,
+                **kwargs)
+            return self.mask_output(self.drop(output)), hidden
+        emb = self.drop(self.encoder(input))
+        output, hidden = self.rnn(emb, hidden, **kwargs)
+        return self.mask_output(self.drop(output)), hidden
+
+    def mask_output(self, output):
+        # Same as zeroing the decoder columns of the ablated units
+        if self.decoder_mask is None:
+            return output
+        return output * self.decoder_mask
+
+    def score_targets(self, output, targets, normalise=True):
+        """
+        Decode only the target words instead of the whole vocabulary.
+        Args:
+            output (Tensor): [batch, nhid] output of the last layer
+            targets (LongTensor): [batch, k] vocabulary indices to score
+            normalise (bool): subtract the log partition function, which still
+                              needs the full decoder, but only for this step
+        Returns:
+            Tensor: [batch, k] log probabilities of the targets, or their
+                    unnormalised logits if normalise is False
+        """
+        weight = self.decoder.weight[targets]
+        logits = torch.bmm(weight, output.unsqueeze(2)).squeeze(2) +\
+            self.decoder.bias[targets]
+        if normalise:
+            logits = logits - torch.logsumexp(self.decoder(output), 1, keepdim=True)
+        return logits
+
+    @contextlib.contextmanager
+    def ablate(self, units, kind="recurrent"):
+        """
+        Ablate units for the duration of a with block. Only the weights that
+        are zeroed are saved, and they are restored on exit.
+        Args:
+            units (list): unit numbers, counting on from layer 0 into layer 1
+            kind (str): "recurrent" zeroes the weights from the units back into
+                        their own layer (columns of weight_hh), and their
+                        decoder weights for units in the last layer;
+                        "input" zeroes the input-to-hidden weights of the units
+                        (their rows of weight_ih, for every gate), so that they
+                        only see their own layer's previous state;
+                        "output_gate" closes the output gate of the units, so
+                        that their hidden state is always 0
+        Decoder columns are not zeroed but masked in the output of forward and
+        rnn_forward, so the decoder, by far the largest weight, is never
+        written and stays shared between processes that memory-map the model
+        (see predict.load_snapshot). The recurrent weights that are zeroed are
+        copied by every process that ablates them.
+        """
+        saved = []
+        previous_mask = self.decoder_mask
+        decoder_mask = torch.ones(self.nhid, device=self.decoder.weight.device)\
+            if previous_mask is None else previous_mask.clone()
+
+        def zero(weight, index, value=0):
+            saved.append((weight, index, weight.data[index].clone()))
+            weight.data[index] = value
+
+        try:
+            for u in units:
+                if not self.nhid * self.nlayers > u >= 0:
+                    raise ValueError("Invalid unit number")
+                layer, column = divmod(u, self.nhid)
+                last = layer == self.nlayers - 1
+
+                if kind == "recurrent":
+                    zero(getattr(self.rnn, f"weight_hh_l{layer}"),
+                        (slice(None), column))
+                    if last:
+                        decoder_mask[column] = 0
+                elif kind == "input":
+                    # Gates are stacked in blocks of nhid rows
+                    weight = getattr(self.rnn, f"weight_ih_l{layer}")
+                    for gate in range(weight.size(0) // self.nhid):
+                        zero(weight, gate * self.nhid + column)
+                elif kind == "output_gate":
+                    # Gates are stacked as input, forget, cell, output
+                    row = 3 * self.nhid + column
+                    zero(getattr(self.rnn, f"weight_ih_l{layer}"), row)
+                    zero(getattr(self.rnn, f"weight_hh_l{layer}"), row)
+                    zero(getattr(self.rnn, f"bias_ih_l{layer}"), row, float("-inf"))
+                else:
+                    raise ValueError(f"Unknown kind of ablation: {kind}")
+
+            if not bool(decoder_mask.all()):
+                self.decoder_mask = decoder_mask
+            yield self
+        finally:
+            self.decoder_mask = previous_mask
+            # Reversed, so a unit that was ablated twice gets its original
+            # values back
+            for weight, index, values in reversed(saved):
+                weight.data[index] = values
+
     def init_hidden(self, bsz):
         weight = next(self.parameters()).data
         if self.rnn_type == 'LSTM':
@@ -4,10 +4,13 @@ import argparse
 import data, lstm
 import numpy as np
 import pickle, pandas
-import copy
+import hashlib
 
 from tqdm import tqdm
 from torch.autograd import Variable
+from results import ResultsStore
+from tasks import task_files, compile_task, number_frame, length_batches,\
+    prefix_trie
 
 def feed_input(model, hidden, word, vocab, cuda):
     input = torch.autograd.Variable(torch.LongTensor([[vocab.word2idx[word]]]))
@@ -24,50 +27,378 @@ def feed_sentence(model, hidden, sentence, vocab, cuda):
     return outputs, hidden
 
 
+def warm_up(model, vocab, cuda, sentence=" ".join([". <eos>"] * 5), bsz=1,
+        grad=False, **kwargs):
+    # Initial sentences are all . <eos>, feed these to the model
+    # (Do not start in the original state). Only the hidden state is needed,
+    # so the decoder is skipped. Keyword arguments (e.g. masks with bsz rows)
+    # are passed on to lstm.forward; with grad, gradients can flow back to them.
+    hidden = model.init_hidden(bsz)
+    input = torch.from_numpy(vocab.encode(sentence.split(" "))).unsqueeze(1)
+    input = input.expand(-1, bsz).contiguous()
+    if cuda:
+        input = input.cuda()
+
+    with torch.set_grad_enabled(grad):
+        _, hidden = model.rnn_forward(input, hidden, record=False, **kwargs)
+
+    return hidden
+
+
+def checkpoint_hash(model_file):
+    # Content hash of a checkpoint, so that renamed or overwritten files are
+    # recognised
+    h = hashlib.sha1()
+    with open(model_file, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+class WarmUpCache(object):
+    """
+    Initial hidden states computed by warm_up, kept in memory and, if a
+    directory is given, on disk so that they are reused by later runs.
+    States are keyed by the content hash of the checkpoint, the warm-up
+    sentence and the set of ablated units.
+    """
+
+    def __init__(self, checkpoint_hash, directory=None):
+        self.checkpoint_hash = checkpoint_hash
+        self.directory = directory
+        self.states = {}
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory)
+
+    def key(self, sentence, units, kind="recurrent"):
+        units = ",".join(str(u) for u in sorted(set(units)))
+        # Other kinds of ablation (see RNNModel.ablate) are keyed separately.
+        # "input" once zeroed the weights into the next layer, states of such
+        # ablations that are still on disk must not be reused
+        if kind == "input":
+            units = f"input_to_hidden:{units}"
+        elif kind != "recurrent":
+            units = f"{kind}:{units}"
+        return hashlib.sha1(
+            f"{self.checkpoint_hash}|{sentence}|{units}".encode()).hexdigest()
+
+    def get(self, sentence, units=(), kind="recurrent"):
+        """Returns the cached (h, c) on the CPU, or None"""
+        key = self.key(sentence, units, kind)
+        if key not in self.states and self.directory:
+            path = os.path.join(self.directory, f"{key}.pt")
+            if os.path.exists(path):
+                self.states[key] = torch.load(path)
+        return self.states.get(key)
+
+    def put(self, sentence, units, init_h, kind="recurrent"):
+        key = self.key(sentence, units, kind)
+        self.states[key] = tuple(h.detach().cpu().clone() for h in init_h)
+        if self.directory:
+            # Write to a temporary file first, other processes may be reading
+            path = os.path.join(self.directory, f"{key}.pt")
+            tmp_path = f"{path}.{os.getpid()}.tmp"
+            torch.save(self.states[key], tmp_path)
+            os.replace(tmp_path, path)
+
+
+def cached_warm_up(model, vocab, cuda, sentence, cache=None, units=(),
+        kind="recurrent"):
+    # warm_up for a model that is (or is not) ablated with units, looked up in
+    # the cache first if there is one
+    if cache is not None:
+        init_h = cache.get(sentence, units, kind)
+        if init_h is not None:
+            return tuple(h.cuda() for h in init_h) if cuda else init_h
+
+    init_h = warm_up(model, vocab, cuda, sentence)
+    if cache is not None:
+        cache.put(sentence, units, init_h, kind)
+    return init_h
+
+
+def save_snapshot(model, path, source):
+    # Copy of a checkpoint in the zip format of torch.save, which unlike older
+    # checkpoints can be memory-mapped by load_snapshot
+    stat = os.stat(source)
+    snapshot = {
+        "source": {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns},
+        "model": model,
+    }
+    # Write to a temporary file first, other processes may be reading
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    torch.save(snapshot, tmp_path)
+    os.replace(tmp_path, path)
+
+
+def load_snapshot(path, source):
+    # Model saved with save_snapshot, or None if there is no such file for the
+    # current version of the checkpoint. The parameters are memory-mapped
+    # copy-on-write, so pages that are not written to (e.g. the embeddings and
+    # the decoder, which RNNModel.ablate masks instead of zeroing) are shared
+    # by all processes using the model.
+    if not os.path.exists(path):
+        return None
+    snapshot = torch.load(path, map_location="cpu", mmap=True, weights_only=False)
+    stat = os.stat(source)
+    if snapshot["source"] != {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns}:
+        return None
+    return snapshot["model"]
+
+
 def load_model(model_file, cuda):
-    # Load model
-    model = torch.load(model_file, map_location=lambda storage, loc: storage)
+    # Load model, from the memory-mapped copy next to the checkpoint if there
+    # is one, otherwise from the checkpoint, after which the copy is written
+    # for next time
+    snapshot_file = f"{model_file}.snapshot"
+    model = load_snapshot(snapshot_file, model_file)
+    if model is None:
+        model = torch.load(model_file, map_location=lambda storage, loc: storage,
+            weights_only=False)
+        try:
+            save_snapshot(model, snapshot_file, model_file)
+        except OSError:
+            pass
+
     if cuda:
         model.cuda()
     model.rnn.flatten_parameters()
 
     # Send extra argument with model parameters to forward function
-    model.rnn.forward = lambda input, hidden: lstm.forward(model.rnn, input, hidden)
-    model_original = copy.deepcopy(model.state_dict())
-    model.load_state_dict(model_original)
+    model.rnn.forward = lambda input, hidden, **kwargs:\
+        lstm.forward(model.rnn, input, hidden, **kwargs)
 
     return model
 
 
-def get_predictions(data, sentences, model, init_out, init_h, vocab, cuda):
+def get_predictions(task, model, init_h, cuda, log_odds=False, hook=None):
     # Initialise log probabilities at 0
-    log_p_targets_correct = np.zeros((len(sentences), 1))
-    log_p_targets_wrong = np.zeros((len(sentences), 1))
+    log_p_targets_correct = np.zeros((len(task["verb_index"]), 1))
+    log_p_targets_wrong = np.zeros((len(task["verb_index"]), 1))
+
+    with torch.no_grad():
+        for i in tqdm(range(len(task["verb_index"]))):
+            # Only the verb is scored, so the sentence is fed up to the verb
+            start = task["offsets"][i]
+            input = torch.from_numpy(np.array(
+                task["tokens"][start:start + task["verb_index"][i]])).unsqueeze(1)
+            targets = torch.LongTensor([[int(task["correct_verb"][i]),
+                int(task["incorrect_verb"][i])]])
+            if cuda:
+                input, targets = input.cuda(), targets.cuda()
+
+            out, _ = model.rnn_forward(input, init_h, record=False,
+                hook=hook(np.array([i])) if hook else None)
+            scores = model.score_targets(out[-1], targets, not log_odds)
+            log_p_targets_correct[i] = scores[0, 0].item()
+            log_p_targets_wrong[i] = scores[0, 1].item()
+
+    return log_p_targets_correct, log_p_targets_wrong
+
+
+class LayerCache(object):
+    """
+    Output of layer first_layer - 1 at every token fed to the model (the
+    tokens before the verb), computed once from init_h. Ablations that do not
+    change the layers below first_layer, e.g. of units in layer 1 only, can
+    then replay the layers from first_layer on. The outputs are kept in memory,
+    or in a memory-mapped .npy file at path.
+    """
+
+    def __init__(self, task, model, init_h, first_layer, cuda, batch_size=64,
+            path=None):
+        self.task = task
+        self.first_layer = first_layer
+        shape = (int(task["offsets"][-1]), model.nhid)
+        if path:
+            self.outputs = np.lib.format.open_memmap(path, mode="w+",
+                dtype=np.float32, shape=shape)
+        else:
+            self.outputs = np.zeros(shape, dtype=np.float32)
+
+        with torch.no_grad():
+            for rows, input in tqdm(length_batches(task, batch_size)):
+                input = torch.from_numpy(input)
+                if cuda:
+                    input = input.cuda()
+                hidden = tuple(h.expand(-1, len(rows), -1).contiguous()
+                    for h in init_h)
+                positions = self.positions(rows, len(input))
+
+                def store(step, layer, hidden, gates):
+                    if layer == first_layer - 1:
+                        self.outputs[positions[step]] = hidden[0].cpu().numpy()
+
+                model.rnn_forward(input, hidden, record=False, hook=store)
+
+    def positions(self, rows, length):
+        # [length, rows] positions of the tokens in the outputs
+        return (self.task["offsets"][rows, None] + np.arange(length)).T
+
+    def batch(self, rows, length):
+        """
+        Returns:
+            Tensor: [length, len(rows), nhid] input for model.rnn_forward with
+                    first_layer
+        """
+        return torch.from_numpy(self.outputs[self.positions(rows, length)])
+
 
-    for i, sentence in enumerate(tqdm(sentences)):
-        sentence = sentence.split(" ")
-        out = None
-        hidden = init_h
+def get_predictions_batched(task, model, init_h, cuda, batch_size=64,
+        log_odds=False, hook=None, layer_cache=None):
+    # Same output as get_predictions, but sentences with the same verb index
+    # are fed together as one [verb_index, batch] input. hook(rows) returns
+    # the lstm.forward hook for a batch of sentences, e.g.
+    # ActivationRecorder.hook. With a LayerCache of the task only the layers
+    # from layer_cache.first_layer on are fed.
+    log_p_targets_correct = np.zeros((len(task["verb_index"]), 1))
+    log_p_targets_wrong = np.zeros((len(task["verb_index"]), 1))
+    first_layer = layer_cache.first_layer if layer_cache else 0
 
-        for j, token in enumerate(sentence):
-            # Unknown word
-            if token not in vocab.word2idx:
-                token = "<unk>"
+    with torch.no_grad():
+        for rows, input in tqdm(length_batches(task, batch_size)):
+            input = layer_cache.batch(rows, len(input)) if layer_cache\
+                else torch.from_numpy(input)
+            targets = torch.from_numpy(np.stack(
+                [task["correct_verb"][rows], task["incorrect_verb"][rows]], 1))
+            if cuda:
+                input, targets = input.cuda(), targets.cuda()
+
+            # Every sentence in the batch starts from the same initial state
+            hidden = tuple(h.expand(-1, len(rows), -1).contiguous() for h in init_h)
+
+            out, _ = model.rnn_forward(input, hidden, first_layer, record=False,
+                hook=hook(rows) if hook else None)
+            scores = model.score_targets(out[-1], targets, not log_odds).cpu().numpy()
+
+            log_p_targets_correct[rows, 0] = scores[:, 0]
+            log_p_targets_wrong[rows, 0] = scores[:, 1]
+
+    return log_p_targets_correct, log_p_targets_wrong
+
+
+def repeat_masks(masks, n):
+    # Repeat every row of the masks n times, following the order of
+    # Tensor.repeat_interleave
+    repeated = {}
+    for k, v in masks.items():
+        if isinstance(v, dict):
+            repeated[k] = {l: m.repeat_interleave(n, 0) for l, m in v.items()}
+        else:
+            repeated[k] = v.repeat_interleave(n, 0)
+    return repeated
+
+
+def get_predictions_masked(task, model, init_h, masks, cuda, batch_size=64,
+        log_odds=False, layer_cache=None):
+    # Evaluates several ablations in one pass. masks holds keyword arguments
+    # for lstm.forward (recurrent_mask, output_mask) with one row per ablation,
+    # init_h one state per ablation. Every batch of sentences is repeated for
+    # each ablation, so the output has one column per ablation. With a
+    # LayerCache, the ablations must leave the layers it replaces unchanged.
+    n_ablations = init_h[0].size(1)
+    log_p_targets_correct = np.zeros((len(task["verb_index"]), n_ablations))
+    log_p_targets_wrong = np.zeros((len(task["verb_index"]), n_ablations))
+    first_layer = layer_cache.first_layer if layer_cache else 0
 
-            input = Variable(torch.LongTensor([[vocab.word2idx[token]]]))
+    with torch.no_grad():
+        for rows, input in tqdm(length_batches(task, batch_size)):
+            # Row a * len(rows) + i holds sentence i under ablation a
+            if layer_cache:
+                input = layer_cache.batch(rows, len(input)).repeat(1, n_ablations, 1)
+            else:
+                input = torch.from_numpy(input).repeat(1, n_ablations)
+            targets = torch.from_numpy(np.stack(
+                [task["correct_verb"][rows], task["incorrect_verb"][rows]], 1))
+            targets = targets.repeat(n_ablations, 1)
+            if cuda:
+                input, targets = input.cuda(), targets.cuda()
+
+            hidden = tuple(h.repeat_interleave(len(rows), 1) for h in init_h)
+            batch_masks = repeat_masks(masks, len(rows))
+
+            out, _ = model.rnn_forward(input, hidden, first_layer, record=False,
+                **batch_masks)
+            scores = model.score_targets(out[-1], targets, not log_odds)
+            scores = scores.view(n_ablations, len(rows), 2).cpu().numpy()
+
+            log_p_targets_correct[rows, :] = scores[:, :, 0].T
+            log_p_targets_wrong[rows, :] = scores[:, :, 1].T
+
+    return log_p_targets_correct, log_p_targets_wrong
+
+
+def get_predictions_trie(task, model, init_h, cuda, max_states=1024,
+        log_odds=False):
+    # Same output as get_predictions, but every prefix shared by several
+    # sentences is fed only once: the prefixes are walked as a trie and all
+    # children of a node are fed together, branching from the node's state.
+    # The states of a node are released once its subtree has been scored and
+    # at most max_states children are fed at once, so no more than
+    # max_states states per trie level are kept in memory.
+    log_p_targets_correct = np.zeros((len(task["verb_index"]), 1))
+    log_p_targets_wrong = np.zeros((len(task["verb_index"]), 1))
+
+    trie, n_nodes = prefix_trie(task)
+    print(f"Feeding {n_nodes} prefix tokens instead of "
+          f"{int(task['verb_index'].sum())}")
+    progress = tqdm(total=n_nodes)
+
+    def visit(node, out, hidden):
+        rows = node["rows"]
+        if rows:
+            targets = torch.from_numpy(np.stack(
+                [task["correct_verb"][rows], task["incorrect_verb"][rows]], 1))
+            if cuda:
+                targets = targets.cuda()
+            scores = model.score_targets(out.expand(len(rows), -1), targets,
+                not log_odds).cpu().numpy()
+            log_p_targets_correct[rows, 0] = scores[:, 0]
+            log_p_targets_wrong[rows, 0] = scores[:, 1]
+
+        children = list(node["children"].items())
+        for start in range(0, len(children), max_states):
+            chunk = children[start:start + max_states]
+            input = torch.LongTensor([[token for token, _ in chunk]])
             if cuda:
                 input = input.cuda()
+            hidden_chunk = tuple(h.expand(-1, len(chunk), -1) for h in hidden)
+            out_chunk, hidden_chunk = model.rnn_forward(input, hidden_chunk,
+                record=False)
+            progress.update(len(chunk))
 
-            out, hidden = model(input, hidden)
-            out = torch.nn.functional.log_softmax(out[0]).unsqueeze(0)
-            #
-            if j == data.loc[i, "verb_index"] - 1:
-                log_p_targets_correct[i] = out[0, 0, vocab.word2idx[data.loc[i, "correct_verb"]]].data.item()
-                log_p_targets_wrong[i] = out[0, 0, vocab.word2idx[data.loc[i, "incorrect_verb"]]].data.item()
+            for i, (_, child) in enumerate(chunk):
+                visit(child, out_chunk[0, i:i+1],
+                    tuple(h[:, i:i+1] for h in hidden_chunk))
+
+    with torch.no_grad():
+        visit(trie, None, init_h)
+    progress.close()
 
     return log_p_targets_correct, log_p_targets_wrong
 
 
+def evaluate_task(task_data, task, model, init_h, vocab, args, hook=None,
+        layer_cache=None):
+    # Pick the evaluation method from the command line arguments. The prefix
+    # trie shares states between sentences, so a hook needs one of the others;
+    # a LayerCache is only replayed in batches
+    if args.prefix_trie and hook is None and layer_cache is None:
+        log_p_targets_correct, log_p_targets_wrong =\
+            get_predictions_trie(task, model, init_h, args.cuda, args.max_states,
+                args.log_odds)
+    elif args.batch_size > 1 or layer_cache is not None:
+        log_p_targets_correct, log_p_targets_wrong =\
+            get_predictions_batched(task, model, init_h, args.cuda,
+                args.batch_size, args.log_odds, hook, layer_cache)
+    else:
+        log_p_targets_correct, log_p_targets_wrong =\
+            get_predictions(task, model, init_h, args.cuda, args.log_odds, hook)
+
+    return categorise_predictions(task_data, task_data.index,
+        log_p_targets_correct, log_p_targets_wrong)
+
+
 def categorise_predictions(data, sentences, log_p_targets_correct, log_p_targets_wrong):
     nums = sum("number" in col for col in list(data))
     options = ["singular", "plural"]
@@ -82,6 +413,7 @@ def categorise_predictions(data, sentences, log_p_targets_correct, log_p_targets
         'log_p_targets_wrong': log_p_targets_wrong,
         'score_on_task': score_on_task,
         'accuracy_score_on_task': score_on_task,
+        'p_difference': score_on_task_p_difference,
     }
 
     if nums == 1:
@@ -90,6 +422,7 @@ def categorise_predictions(data, sentences, log_p_targets_correct, log_p_targets
             relevant_idx = np.array(data.index[data["number1"] == num1])
             scores = correct.flatten()[relevant_idx]
             info[f"accuracy_{num1}"] = np.mean(scores)
+            info[f"p_difference_{num1}"] = np.mean(p_difference.flatten()[relevant_idx])
             print(f"accuracy for {num1}: {np.mean(scores) * 100}")
 
     elif nums == 2:
@@ -99,6 +432,8 @@ def categorise_predictions(data, sentences, log_p_targets_correct, log_p_targets
                                             (data["number2"] == num2)])
                 scores = correct.flatten()[relevant_idx]
                 info[f"accuracy_{num1}_{num2}"] = np.mean(scores)
+                info[f"p_difference_{num1}_{num2}"] =\
+                    np.mean(p_difference.flatten()[relevant_idx])
                 print(f"accuracy for {num1}_{num2}: {np.mean(scores) * 100}")
 
     elif nums == 3:
@@ -110,9 +445,99 @@ def categorise_predictions(data, sentences, log_p_targets_correct, log_p_targets
                                                 (data["number3"] == num3)])
                     scores = correct.flatten()[relevant_idx]
                     info[f"accuracy_{num1}_{num2}_{num3}"] = np.mean(scores)
+                    info[f"p_difference_{num1}_{num2}_{num3}"] =\
+                        np.mean(p_difference.flatten()[relevant_idx])
                     print(f"accuracy for {num1}_{num2}_{num3}: {np.mean(scores) * 100}")
 
     print('accuracy: ' + str(100*score_on_task/len(sentences)))
     print('p_difference: %1.3f +- %1.3f' % (score_on_task_p_difference, score_on_task_p_difference_std))
 
     return info
+
+
+def add_evaluation_arguments(parser):
+    # Arguments shared by predict.py and ablation.py
+    parser.add_argument("-v", "--vocabulary", type=str,
+        default="data/vocabulary/vocab.txt",
+        help="Vocabulary of the training corpus that the model was trained on")
+    parser.add_argument("--eos", type=str, default="<eos>",
+        help="Token that indicates end of sentence")
+    parser.add_argument("--unk", type=str, default="<unk>",
+        help="Token that indicates an unknown token")
+    parser.add_argument("--cuda", action="store_true", default=False)
+    parser.add_argument("-b", "--batch_size", type=int, default=1,
+        help="Number of sentences to feed at once (1 feeds them one by one)")
+    parser.add_argument("--prefix_trie", action="store_true", default=False,
+        help="Feed prefixes shared by several sentences only once")
+    parser.add_argument("--max_states", type=int, default=1024,
+        help="Maximum number of trie nodes to feed at once with --prefix_trie")
+    parser.add_argument("--log_odds", action="store_true", default=False,
+        help="Store unnormalised verb logits instead of log probabilities; "
+        "accuracy is unaffected, but the p_difference is no longer meaningful")
+    parser.add_argument("--warm_up_cache", type=str, default=None,
+        help="Directory to store and reuse initial hidden states in")
+    parser.add_argument("--results_db", type=str, default=None,
+        help="SQLite database to append the results to, next to the .info files")
+    parser.add_argument("--store_log_probs", action="store_true", default=False,
+        help="Also store the log probabilities of every sentence in --results_db")
+
+
+def read_tasks(paths, vocab, unk):
+    """
+    Tasks are compiled to memory-mapped arrays the first time they are read,
+    see tasks.compile_task.
+    Returns:
+        list: (template, number conditions, encoded task) for every tsv file
+              in paths
+    """
+    tasks = []
+    for path in task_files(paths):
+        task = compile_task(path, vocab, unk)
+        template = path.split("/")[-1].replace(".tsv", "")
+        tasks.append((template, number_frame(task), task))
+    return tasks
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-m", "--model", type=str, nargs="+",
+        default=["models/model.pt"], help="Models (meta files) to evaluate")
+    parser.add_argument("-i", "--input", type=str, nargs="+", required=True,
+        help="Input sentences (tsv files or directories of tsv files)")
+    parser.add_argument("-o", "--output", type=str, default="output",
+        help="Output directory, with a subdirectory per model if there are "
+        "several models")
+    add_evaluation_arguments(parser)
+    args = parser.parse_args()
+
+    # The vocabulary and tasks are read once for all models
+    vocab = data.Dictionary(args.vocabulary)
+    tasks = read_tasks(args.input, vocab, args.unk)
+    store = ResultsStore(args.results_db) if args.results_db else None
+
+    for model_file in args.model:
+        output_dir = args.output
+        if len(args.model) > 1:
+            output_dir = os.path.join(args.output,
+                model_file.split("/")[-1].replace(".pt", ""))
+        if not os.path.exists(output_dir):
+            os.makedirs(output_dir)
+
+        # The model and its initial state are shared by all templates
+        model = load_model(model_file, args.cuda)
+        cache = None
+        if args.warm_up_cache:
+            cache = WarmUpCache(checkpoint_hash(model_file), args.warm_up_cache)
+        init_h = cached_warm_up(model, vocab, args.cuda,
+            " ".join([f". {args.eos}"] * 5), cache)
+
+        for template, task_data, task in tasks:
+            print(f"Evaluating {template} with {model_file}")
+            info = evaluate_task(task_data, task, model, init_h, vocab, args)
+
+            with open(os.path.join(output_dir, f"{template}.info"), "wb") as f:
+                pickle.dump(info, f, -1)
+            print(f"Information saved to {output_dir}/{template}.info\n")
+            if store is not None:
+                store.append(model_file, template, [(None, info)],
+                    log_probs=args.store_log_probs)
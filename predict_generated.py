@@ -0,0 +1,156 @@
+import sys, os
+import argparse
+import itertools
+import random
+import pickle
+import numpy as np
+
+import data
+from predict import *
+from tasks import NUMBERS, number_frame
+
+# The generation scripts live in data/ and import each other by name
+sys.path.insert(1, os.path.join(os.path.dirname(os.path.abspath(__file__)), "data"))
+from grammar import TEMPLATES, get_grammar_string
+from generate_tasks import ABBREVIATIONS, add_vocabulary_arguments,\
+    read_vocabulary, generate_dataset, post_process
+from finalise_tasks import reservoir_sample, balanced_sample
+
+
+def generate_records(template, vocabulary, vocab, unk="<unk>"):
+    """
+    Generate the sentences of a template as vocabulary indices, without
+    writing them to a tsv file first.
+
+    Args:
+        template (str): template known to get_grammar_string
+        vocabulary (dict): output of read_vocabulary
+        vocab (data.Dictionary): vocabulary the model was trained on
+        unk (str): token that replaces words not in the vocabulary
+    Yields:
+        dict: "tokens" (indices of the sentence up to and including the verb),
+              "subject_index", "verb_index", "correct_verb", "incorrect_verb"
+              and "numbers", e.g. ("singular", "plural")
+    """
+    grammar, correct, incorrect = get_grammar_string(template, **vocabulary)
+
+    for agr, disagr, condition in generate_dataset(grammar, correct, incorrect):
+        agr, subject_index, verb_index, _ = post_process(agr)
+        disagr, _, _, _ = post_process(disagr)
+        agr, verb_index = agr.split(" "), int(verb_index)
+        correct_verb, incorrect_verb = vocab.encode(
+            [agr[verb_index], disagr.split(" ")[verb_index]])
+        yield {
+            "tokens": vocab.encode(agr, unk),
+            "subject_index": int(subject_index),
+            "verb_index": verb_index,
+            "correct_verb": correct_verb,
+            "incorrect_verb": incorrect_verb,
+            "numbers": tuple(ABBREVIATIONS[k] for k in condition.split("_")),
+        }
+
+
+def records_to_task(records):
+    """
+    Args:
+        records (list): output of generate_records, not empty
+    Returns:
+        dict: encoded task, as made by tasks.encode_task
+    """
+    lengths = [len(r["tokens"]) for r in records]
+    task = {
+        "tokens": np.concatenate([r["tokens"] for r in records]),
+        "offsets": np.concatenate([[0], np.cumsum(lengths)]).astype(np.int64),
+        "numbers": np.array([[NUMBERS.index(n) for n in r["numbers"]]
+            for r in records], dtype=np.int8),
+    }
+    for k in ["subject_index", "verb_index", "correct_verb", "incorrect_verb"]:
+        task[k] = np.array([r[k] for r in records], dtype=np.int64)
+    return task
+
+
+def sample_records(records, k, rng):
+    """
+    Balanced sample of at most k records per number condition, as made by
+    finalise_tasks.py for a tsv file.
+    """
+    records = iter(records)
+    first = next(records, None)
+    if first is None:
+        return []
+    conditions = list(itertools.product(["singular", "plural"],
+        repeat=len(first["numbers"])))
+    reservoirs, counts = reservoir_sample(itertools.chain([first], records),
+        lambda r: r["numbers"], conditions, k, rng)
+    sampled, _ = balanced_sample(reservoirs, counts, k, rng)
+    return sampled
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-m", "--model", type=str, nargs="+",
+        default=["models/model.pt"], help="Models (meta files) to evaluate")
+    parser.add_argument("-t", "--template", type=str, nargs="+", required=True,
+        help="Templates to generate and evaluate, or 'all'")
+    parser.add_argument("-o", "--output", type=str, default="output_generated",
+        help="Output directory, with a subdirectory per model if there are "
+        "several models")
+    parser.add_argument("-d", "--data_directory", type=str, default="data",
+        help="Directory with the vocabulary directory of the templates")
+    parser.add_argument("-n", "--number", type=int, default=-1,
+        help="Number of sentences to sample per condition (default: all)")
+    parser.add_argument("-s", "--seed", type=int, default=None,
+        help="Random seed for sampling words and sentences")
+    add_vocabulary_arguments(parser)
+    add_evaluation_arguments(parser)
+    args = parser.parse_args()
+
+    templates = TEMPLATES if args.template == ["all"] else args.template
+    random.seed(args.seed)
+    rng = random.Random(args.seed)
+
+    vocab = data.Dictionary(args.vocabulary)
+    vocabulary = read_vocabulary(args,
+        os.path.join(args.data_directory, "vocabulary"))
+
+    store = ResultsStore(args.results_db) if args.results_db else None
+
+    tasks = []
+    for template in templates:
+        print(f"Generating {template}")
+        records = generate_records(template, vocabulary, vocab, args.unk)
+        if args.number > 0:
+            records = sample_records(records, args.number, rng)
+        records = list(records)
+        if not records:
+            sys.exit(f"No sentences generated for {template}. Please check "
+                "the vocabulary of the template.")
+        task = records_to_task(records)
+        print(f"{len(task['verb_index'])} sentences")
+        tasks.append((template, number_frame(task), task))
+
+    for model_file in args.model:
+        output_dir = args.output
+        if len(args.model) > 1:
+            output_dir = os.path.join(args.output,
+                model_file.split("/")[-1].replace(".pt", ""))
+        if not os.path.exists(output_dir):
+            os.makedirs(output_dir)
+
+        model = load_model(model_file, args.cuda)
+        cache = None
+        if args.warm_up_cache:
+            cache = WarmUpCache(checkpoint_hash(model_file), args.warm_up_cache)
+        init_h = cached_warm_up(model, vocab, args.cuda,
+            " ".join([f". {args.eos}"] * 5), cache)
+
+        for template, task_data, task in tasks:
+            print(f"Evaluating {template} with {model_file}")
+            info = evaluate_task(task_data, task, model, init_h, vocab, args)
+
+            with open(os.path.join(output_dir, f"{template}.info"), "wb") as f:
+                pickle.dump(info, f, -1)
+            print(f"Information saved to {output_dir}/{template}.info\n")
+            if store is not None:
+                store.append(model_file, template, [(None, info)],
+                    log_probs=args.store_log_probs)
@@ -1,28 +1,46 @@
-from results import read_results
+import os
+from results import read_results, ResultsStore
+
+UNIT = "873"
+RESULTS_DB = "output_ablation/results.db"
+# Run whose results are read from the database (ablation.py -m and --ablation)
+MODEL = "models/model.pt"
+ABLATION = "recurrent"
+
+# With a results database (ablation.py --results_db) all templates are read in
+# one query; templates that are not in it are read from their .info file
+accuracies = None
+if os.path.exists(RESULTS_DB):
+    accuracies = ResultsStore(RESULTS_DB).table(unit=UNIT, model=MODEL,
+        ablation=ABLATION)
 
 for task in ["adv", "namepp", "noun_conj", "qnty_namepp", "qnty_nounpp", "nounpp",
             "qnty_simple", "rel_def_obj", "rel_def", "rel_nondef", "s_conj",
             "simple", "that_adv", "that_compl", "that_nounpp", "that"]:
 
     print(f"Reading results of {task}")
-    res = read_results(f"output_ablation/{task}.info")
+    if accuracies is not None and (task, UNIT) in accuracies.index:
+        res = {f"accuracy_{c}": v
+            for c, v in accuracies.loc[(task, UNIT)].dropna().items()}
+    else:
+        res = read_results(f"output_ablation/{task}.info")[UNIT]
 
     if task in ["simple", "adv", "namepp", "qnty_simple", "qnty_namepp", "rel_def", "rel_nondef"]:
-        print(f"S {res["873"]["accuracy_plural"]}")
-        print(f"P {res["873"]["accuracy_singular"]}")
+        print(f"S {res['accuracy_plural']}")
+        print(f"P {res['accuracy_singular']}")
 
     elif task in ["nounpp", "noun_conj", "qnty_nounpp", "that", "that_adv", "that_compl", "rel_def_obj", "s_conj"]:
-        print(f"SS {res["873"]["accuracy_singular_singular"]}")
-        print(f"SP {res["873"]["accuracy_singular_plural"]}")
-        print(f"PS {res["873"]["accuracy_plural_singular"]}")
-        print(f"PP {res["873"]["accuracy_plural_plural"]}")
+        print(f"SS {res['accuracy_singular_singular']}")
+        print(f"SP {res['accuracy_singular_plural']}")
+        print(f"PS {res['accuracy_plural_singular']}")
+        print(f"PP {res['accuracy_plural_plural']}")
 
     elif task == "that_nounpp":
-        print(f"SSS {res["873"]["accuracy_singular_singular_singular"]}")
-        print(f"SSP {res["873"]["accuracy_singular_singular_plural"]}")
-        print(f"SPS {res["873"]["accuracy_singular_plural_singular"]}")
-        print(f"SPP {res["873"]["accuracy_singular_plural_plural"]}")
-        print(f"PSS {res["873"]["accuracy_plural_singular_singular"]}")
-        print(f"PSP {res["873"]["accuracy_plural_singular_plural"]}")
-        print(f"PPS {res["873"]["accuracy_plural_plural_singular"]}")
-        print(f"PPP {res["873"]["accuracy_plural_plural_plural"]}")
+        print(f"SSS {res['accuracy_singular_singular_singular']}")
+        print(f"SSP {res['accuracy_singular_singular_plural']}")
+        print(f"SPS {res['accuracy_singular_plural_singular']}")
+        print(f"SPP {res['accuracy_singular_plural_plural']}")
+        print(f"PSS {res['accuracy_plural_singular_singular']}")
+        print(f"PSP {res['accuracy_plural_singular_plural']}")
+        print(f"PPS {res['accuracy_plural_plural_singular']}")
+        print(f"PPP {res['accuracy_plural_plural_plural']}")
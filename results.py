@@ -0,0 +1,144 @@
+import os
+import time
+import pickle
+import sqlite3
+import numpy as np
+import pandas as pd
+
+
+def read_results(filename):
+    try:
+        with open(filename, "rb") as f:
+            data = pickle.load(f)
+            return data
+    except:
+        print(f"{filename} is not readable.")
+
+
+def conditions(info):
+    """
+    Args:
+        info (dict): output of categorise_predictions
+    Returns:
+        list: number conditions in info, e.g. singular_plural
+    """
+    return [k[len("accuracy_"):] for k in info
+        if k.startswith("accuracy_") and k != "accuracy_score_on_task"]
+
+
+def model_filter(filters):
+    # Models are stored by their real path, see ResultsStore.append
+    if "model" in filters:
+        filters = dict(filters, model=os.path.realpath(filters["model"]))
+    return filters
+
+
+class ResultsStore(object):
+    """
+    Results of predict.py and ablation.py in an SQLite table with one row per
+    model, template, kind of ablation, unit and number condition, plus a row
+    with condition "all" for the whole task. Rows are only ever appended, so
+    processes can add results at the same time; the "latest" view holds the
+    most recent row of every combination. The unablated model has unit "-1".
+    """
+
+    def __init__(self, path, timeout=60):
+        self.path = path
+        self.connection = sqlite3.connect(path, timeout=timeout)
+        with self.connection:
+            # Readers do not block writers and the other way around
+            self.connection.execute("PRAGMA journal_mode=WAL")
+            self.connection.execute("""
+                CREATE TABLE IF NOT EXISTS results (
+                    model TEXT, template TEXT, ablation TEXT, unit TEXT,
+                    condition TEXT, accuracy REAL, p_difference REAL,
+                    log_p_correct BLOB, log_p_wrong BLOB, created REAL)""")
+            self.connection.execute("""
+                CREATE INDEX IF NOT EXISTS results_template_unit
+                ON results (template, unit)""")
+            self.connection.execute("""
+                CREATE VIEW IF NOT EXISTS latest AS
+                SELECT * FROM results WHERE rowid IN (
+                    SELECT MAX(rowid) FROM results
+                    GROUP BY model, template, ablation, unit, condition)""")
+
+    def append(self, model, template, results, ablation="recurrent",
+            log_probs=False):
+        """
+        Args:
+            model (str): checkpoint that was evaluated, stored by its real
+                         path so that results do not depend on how it was given
+            template (str): task that was evaluated
+            results (list): (unit key, output of categorise_predictions) pairs,
+                            as passed to ablation.save_info
+            ablation (str): kind of ablation, see RNNModel.ablate
+            log_probs (bool): also store the log probabilities of every
+                              sentence (in the "all" row, as float32)
+        """
+        model = os.path.realpath(model)
+        created = time.time()
+        rows = []
+        for key, info in results:
+            unit = "-1" if key is None else str(key)
+            for c in conditions(info):
+                rows.append((model, template, ablation, unit, c,
+                    float(info[f"accuracy_{c}"]),
+                    float(info.get(f"p_difference_{c}", np.nan)),
+                    None, None, created))
+
+            correct = np.asarray(info["log_p_targets_correct"], dtype=np.float32)
+            wrong = np.asarray(info["log_p_targets_wrong"], dtype=np.float32)
+            rows.append((model, template, ablation, unit, "all",
+                float(info["score_on_task"]) / len(correct),
+                float(info.get("p_difference", np.nan)),
+                correct.tobytes() if log_probs else None,
+                wrong.tobytes() if log_probs else None, created))
+
+        with self.connection:
+            self.connection.executemany(
+                "INSERT INTO results VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", rows)
+
+    def query(self, sql, params=()):
+        """Run an SQL query, e.g. on the latest view, into a DataFrame"""
+        return pd.read_sql_query(sql, self.connection, params=params)
+
+    def table(self, value="accuracy", **filters):
+        """
+        Args:
+            value (str): accuracy or p_difference
+            filters: column values to select, e.g. template="nounpp"; model
+                     and ablation must be given if the store holds several
+        Returns:
+            pandas.DataFrame: value for every (template, unit) and condition
+        Raises:
+            ValueError: if the selected rows come from several models or kinds
+                        of ablation
+        """
+        filters = model_filter(filters)
+        where = " AND ".join(f"{k} = ?" for k in filters) or "1"
+        df = self.query(f"SELECT model, ablation, template, unit, condition, "
+            f"{value} FROM latest WHERE {where}", tuple(filters.values()))
+
+        # Results of different runs are never averaged
+        runs = df[["model", "ablation"]].drop_duplicates()
+        if len(runs) > 1:
+            raise ValueError(f"Results of {len(runs)} (model, ablation) pairs, "
+                "select one with the model and ablation filters")
+        return df.pivot_table(index=["template", "unit"], columns="condition",
+            values=value, aggfunc="first")
+
+    def log_probs(self, template, unit="-1", **filters):
+        """
+        Returns:
+            np.ndarray: log probabilities of the correct verbs, or None if they
+                        were not stored
+            np.ndarray: log probabilities of the incorrect verbs
+        """
+        filters = dict(template=template, unit=str(unit), condition="all",
+            **model_filter(filters))
+        where = " AND ".join(f"{k} = ?" for k in filters)
+        row = self.connection.execute("SELECT log_p_correct, log_p_wrong "
+            f"FROM latest WHERE {where}", tuple(filters.values())).fetchone()
+        if row is None or row[0] is None:
+            return None, None
+        return tuple(np.frombuffer(b, dtype=np.float32) for b in row)
@@ -18,7 +18,10 @@ declare -a templates=('simple'
                     )
 
 
+declare -a inputs=()
 for task in ${templates[@]}; do
-    echo $task
-    python -W ignore ../ablation.py -i data/tasks/$task.tsv -u 873
+    inputs+=("data/tasks/$task.tsv")
 done
+
+# All templates are evaluated with the same ablated model
+python -W ignore ../ablation.py -i ${inputs[@]} -u 873
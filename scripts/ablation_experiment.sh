@@ -1,7 +1,5 @@
 #!/bin/bash
 END=1300
 
-for ((i=0;i<END;i++)); do
-    echo Ablation unit $i
-    python ../ablation.py -i data/tasks/nounpp.tsv -u $i --cuda
-done
+# Ablates each unit on its own, loading the model and data only once
+python ../ablation.py -i data/tasks/nounpp.tsv -u 0 --range_end $((END-1)) --sweep --cuda
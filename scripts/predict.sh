@@ -21,9 +21,13 @@ declare -a templates=('simple'
 declare -a seeds=('22'
                  '23')
 
+declare -a inputs=()
+for task in ${templates[@]}; do
+    inputs+=("data/tasks/$task.tsv")
+done
+
+# One process per model evaluates all templates
 for s in ${seeds[@]}; do
-    for task in ${templates[@]}; do
-        echo Extracting predictions for $task
-        python ../predict.py -m dutch_hidden650_batch64_dropout0.2_lr20.0_seed_$s.pt -i data/tasks/$task.tsv -o output_$s --cuda
-    done
+    echo Extracting predictions for seed $s
+    python ../predict.py -m dutch_hidden650_batch64_dropout0.2_lr20.0_seed_$s.pt -i ${inputs[@]} -o output_$s --cuda
 done
@@ -0,0 +1,253 @@
+import os
+import json
+import fcntl
+import shutil
+import hashlib
+import numpy as np
+import pandas
+
+# Grammatical numbers as stored in the "numbers" array of an encoded task
+NUMBERS = ["singular", "plural"]
+
+# Arrays of an encoded task, each saved as a .npy file by save_task
+TASK_ARRAYS = ["tokens", "offsets", "subject_index", "verb_index",
+    "correct_verb", "incorrect_verb", "numbers"]
+
+
+def task_files(paths):
+    """
+    Args:
+        paths (list): tsv files and directories containing tsv files
+    Returns:
+        list: tsv files, with directories replaced by the files in them
+    """
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            files.extend(sorted(os.path.join(path, f) for f in os.listdir(path)
+                if f.endswith(".tsv")))
+        else:
+            files.append(path)
+    return files
+
+
+def encode_task(data, vocab, unk="<unk>"):
+    """
+    Convert the agreement sentences of a task to indices in the vocabulary.
+
+    Args:
+        data (pandas.DataFrame): task as read from a tsv file in data/tasks
+        vocab (data.Dictionary): vocabulary the model was trained on
+        unk (str): token that replaces words not in the vocabulary
+    Returns:
+        dict: "tokens" holds the indices of all sentences back to back and
+              "offsets" the position where each sentence starts;
+              "subject_index", "verb_index", "correct_verb" and
+              "incorrect_verb" hold one value per sentence and "numbers" the
+              number conditions as [sentences, nouns] indices in NUMBERS
+    """
+    sentences = [sentence.split(" ") for sentence in data["agreement"]]
+    lengths = [len(sentence) for sentence in sentences]
+
+    return {
+        "tokens": vocab.encode([w for sentence in sentences for w in sentence], unk),
+        "offsets": np.concatenate([[0], np.cumsum(lengths)]).astype(np.int64),
+        "subject_index": data["subject_index"].values.astype(np.int64),
+        "verb_index": data["verb_index"].values.astype(np.int64),
+        "correct_verb": vocab.encode(data["correct_verb"].tolist()),
+        "incorrect_verb": vocab.encode(data["incorrect_verb"].tolist()),
+        "numbers": np.array([data[c].map(NUMBERS.index).values
+            for c in data if c.startswith("number")],
+            dtype=np.int8).reshape(-1, len(data)).T.copy(),
+    }
+
+
+def number_frame(task):
+    """
+    Args:
+        task (dict): output of encode_task
+    Returns:
+        pandas.DataFrame: number1, number2, ... columns of the task, as used
+                          by categorise_predictions
+    """
+    numbers = np.asarray(task["numbers"])
+    return pandas.DataFrame({f"number{i+1}": np.array(NUMBERS)[numbers[:, i]]
+        for i in range(numbers.shape[1])}, index=np.arange(len(numbers)))
+
+
+def subset_task(task, rows):
+    """
+    Args:
+        task (dict): output of encode_task
+        rows (np.ndarray): indices of the sentences to keep
+    Returns:
+        dict: encoded task of only these sentences, in the order of rows
+    """
+    rows = np.asarray(rows, dtype=np.int64)
+    starts = np.asarray(task["offsets"])[rows]
+    lengths = np.asarray(task["offsets"])[rows + 1] - starts
+    offsets = np.concatenate([[0], np.cumsum(lengths)]).astype(np.int64)
+
+    # Position in the original tokens of every token of the subset
+    positions = np.repeat(starts - offsets[:-1], lengths) + np.arange(offsets[-1])
+    subset = {k: np.asarray(task[k])[rows] for k in TASK_ARRAYS
+        if k not in ["tokens", "offsets"]}
+    subset["tokens"] = np.asarray(task["tokens"])[positions]
+    subset["offsets"] = offsets
+    return subset
+
+
+def vocab_hash(vocab, unk="<unk>"):
+    """Content hash of a vocabulary, so that encoded tasks can be checked"""
+    sorted_words, order = vocab.index
+    h = hashlib.sha1(sorted_words.tobytes())
+    h.update(order.tobytes())
+    h.update(unk.encode())
+    return h.hexdigest()
+
+
+def save_task(task, directory, meta):
+    """
+    Save an encoded task as a directory of .npy files, which is written next
+    to its final location first and moved there in one step.
+
+    Args:
+        task (dict): output of encode_task
+        directory (str): output directory
+        meta (dict): description of the source, stored as meta.json
+    """
+    tmp_directory = f"{directory}.{os.getpid()}.tmp"
+    os.makedirs(tmp_directory, exist_ok=True)
+    for k in TASK_ARRAYS:
+        np.save(os.path.join(tmp_directory, f"{k}.npy"), task[k])
+    with open(os.path.join(tmp_directory, "meta.json"), "w") as f:
+        json.dump(meta, f)
+
+    try:
+        # A stale task is moved aside before it is removed, so that the
+        # directory is always either the old or the new task
+        if os.path.exists(directory):
+            old_directory = f"{directory}.{os.getpid()}.old"
+            os.replace(directory, old_directory)
+            shutil.rmtree(old_directory, ignore_errors=True)
+        os.replace(tmp_directory, directory)
+    except OSError:
+        shutil.rmtree(tmp_directory, ignore_errors=True)
+        raise
+
+
+def load_task(directory):
+    """
+    Returns:
+        dict: encoded task saved with save_task, with memory-mapped arrays that
+              are shared by all processes reading the same task
+    """
+    return {k: np.load(os.path.join(directory, f"{k}.npy"), mmap_mode="r")
+        for k in TASK_ARRAYS}
+
+
+def compile_task(path, vocab, unk="<unk>"):
+    """
+    Encoded task of a tsv file, compiled once into a <template>.task directory
+    next to the file and memory-mapped afterwards. The compiled task is built
+    again when the tsv file or the vocabulary changes. Processes that read the
+    same task at the same time (e.g. the workers of ablation.py) take turns,
+    so only the first compiles it and none reads it while it is replaced.
+
+    Args:
+        path (str): tsv file in data/tasks
+        vocab (data.Dictionary): vocabulary the model was trained on
+        unk (str): token that replaces words not in the vocabulary
+    Returns:
+        dict: output of encode_task
+    """
+    directory = f"{os.path.splitext(path)[0]}.task"
+    stat = os.stat(path)
+    meta = {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns,
+        "vocab": vocab_hash(vocab, unk)}
+
+    try:
+        lock = open(f"{directory}.lock", "w")
+    except OSError:
+        # Read-only task directory, use the task without compiling it
+        return encode_task(pandas.read_csv(path, sep="\t", header=0), vocab, unk)
+
+    with lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            with open(os.path.join(directory, "meta.json")) as f:
+                if json.load(f) == meta:
+                    return load_task(directory)
+        except (OSError, ValueError):
+            pass
+
+        task = encode_task(pandas.read_csv(path, sep="\t", header=0), vocab, unk)
+        try:
+            save_task(task, directory, meta)
+        except OSError:
+            return task
+        return load_task(directory)
+
+
+def length_batches(task, batch_size):
+    """
+    Group the sentences of an encoded task by the number of tokens before the
+    verb, so that every batch can be fed without padding.
+
+    Args:
+        task (dict): output of encode_task
+        batch_size (int): maximum number of sentences per batch
+    Yields:
+        rows (np.ndarray): indices of the sentences in the batch
+        input (np.ndarray): [verb_index, len(rows)] tokens preceding the verb
+    """
+    yield from batches(task, task["verb_index"], batch_size)
+
+
+def sentence_batches(task, batch_size):
+    """
+    Same as length_batches, but every sentence is fed as a whole, up to and
+    including the verb.
+
+    Yields:
+        rows (np.ndarray): indices of the sentences in the batch
+        input (np.ndarray): [sentence length, len(rows)] tokens
+    """
+    yield from batches(task, np.diff(task["offsets"]), batch_size)
+
+
+def batches(task, lengths, batch_size):
+    # Batches of the first lengths[i] tokens of sentences of the same length
+    for length in np.unique(lengths):
+        same_length = np.flatnonzero(lengths == length)
+        for start in range(0, len(same_length), batch_size):
+            rows = same_length[start:start + batch_size]
+            positions = task["offsets"][rows, None] + np.arange(length)
+            yield rows, task["tokens"][positions].T
+
+
+def prefix_trie(task):
+    """
+    Store the tokens preceding the verb of every sentence in a trie, so that
+    sentences with a common prefix share the nodes of that prefix.
+
+    Args:
+        task (dict): output of encode_task
+    Returns:
+        dict: root node; every node is a dict with "children" (token index to
+              node) and "rows" (sentences whose verb follows this node)
+        int: number of nodes, excluding the root
+    """
+    root = {"children": {}, "rows": []}
+    n_nodes = 0
+
+    for i, (offset, length) in enumerate(zip(task["offsets"], task["verb_index"])):
+        node = root
+        for token in task["tokens"][offset:offset + length].tolist():
+            if token not in node["children"]:
+                node["children"][token] = {"children": {}, "rows": []}
+                n_nodes += 1
+            node = node["children"][token]
+        node["rows"].append(i)
+
+    return root, n_nodes
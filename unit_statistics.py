@@ -0,0 +1,215 @@
+import sys, os
+import pickle
+import argparse
+import numpy as np
+import pandas as pd
+import torch
+
+import data
+from activations import VALUES
+from predict import load_model, cached_warm_up, read_tasks, evaluate_task,\
+    add_evaluation_arguments, WarmUpCache, checkpoint_hash
+from results import ResultsStore
+from tasks import NUMBERS
+
+
+def combine(counts, means, m2s):
+    """
+    Merge running moments of several groups (Chan et al.), along axis 0.
+
+    Args:
+        counts, means, m2s (np.ndarray): [groups, units] count, mean and sum of
+                                         squared differences from the mean
+    Returns:
+        np.ndarray: [units] count, mean and sum of squared differences
+    """
+    count = counts.sum(0)
+    mean = (counts * means).sum(0) / np.maximum(count, 1)
+    m2 = (m2s + counts * (means - mean) ** 2).sum(0)
+    return count, mean, m2
+
+
+class UnitStatistics(object):
+    """
+    Running mean and variance of every unit, per value (hidden and cell state,
+    gates) and number condition, at the subject and at the verb, updated batch
+    by batch through the lstm.forward hook without storing any activations.
+    The verb position is the word before the verb, whose state predicts it.
+    Units are numbered as in ablation.py, layer 1 following layer 0.
+    """
+
+    def __init__(self, task, nhid, nlayers, values=VALUES):
+        """
+        Args:
+            task (dict): output of tasks.encode_task
+            nhid (int): number of units per layer
+            nlayers (int): number of layers
+            values (list): which of activations.VALUES to collect
+        """
+        self.nhid = nhid
+        self.values = list(values)
+        self.numbers = np.asarray(task["numbers"])
+        self.positions = {"subject": np.asarray(task["subject_index"]),
+            "verb": np.asarray(task["verb_index"]) - 1}
+
+        # Condition of every sentence, counting singular before plural with
+        # the first number most significant, as in categorise_predictions
+        n_numbers = self.numbers.shape[1]
+        self.condition = (self.numbers.astype(np.int64)
+            << np.arange(n_numbers)[::-1]).sum(1)
+        self.conditions = ["_".join(NUMBERS[(c >> (n_numbers - 1 - j)) & 1]
+            for j in range(n_numbers)) or "all" for c in range(2 ** n_numbers)]
+
+        shape = (len(self.conditions), nhid * nlayers)
+        self.count = {p: np.zeros(shape, dtype=np.int64) for p in self.positions}
+        self.mean = {(v, p): np.zeros(shape) for v in self.values
+            for p in self.positions}
+        self.m2 = {(v, p): np.zeros(shape) for v in self.values
+            for p in self.positions}
+
+    def hook(self, rows):
+        """
+        Returns:
+            function: hook for lstm.forward that adds the activations of the
+                      sentences in rows at the subject and verb positions
+        """
+        positions = {p: index[rows] for p, index in self.positions.items()}
+        conditions = self.condition[rows]
+
+        def update(step, layer, hidden, gates):
+            columns = slice(layer * self.nhid, (layer + 1) * self.nhid)
+            activations = dict(gates, hidden=hidden[0], cell=hidden[1])
+
+            for p, index in positions.items():
+                for c in np.unique(conditions[index == step]):
+                    selected = np.flatnonzero((index == step) & (conditions == c))
+                    selected_t = torch.from_numpy(selected).to(hidden[0].device)
+                    n_a = self.count[p][c, columns]
+                    n_b = len(selected)
+
+                    for v in self.values:
+                        x = activations[v][selected_t].double().cpu().numpy()
+                        mean_b = x.mean(0)
+                        mean = self.mean[v, p][c, columns]
+                        delta = mean_b - mean
+                        self.m2[v, p][c, columns] += ((x - mean_b) ** 2).sum(0)\
+                            + delta ** 2 * n_a * n_b / (n_a + n_b)
+                        mean += delta * n_b / (n_a + n_b)
+
+                    self.count[p][c, columns] += n_b
+
+        return update
+
+    def moments(self, value, position, column=None, number=None):
+        """
+        Args:
+            value (str): one of the collected values
+            position (str): subject or verb
+            column (int): number column (0 for number1...) to select on, or
+                          None for all sentences
+            number (int): index in tasks.NUMBERS that the column must have
+        Returns:
+            np.ndarray: [units] count, mean and variance
+        """
+        rows = np.arange(len(self.conditions))
+        if column is not None:
+            n_numbers = self.numbers.shape[1]
+            rows = rows[(rows >> (n_numbers - 1 - column)) & 1 == number]
+        count, mean, m2 = combine(self.count[position][rows],
+            self.mean[value, position][rows], self.m2[value, position][rows])
+        return count, mean, m2 / np.maximum(count - 1, 1)
+
+    def effect_size(self, value, position, column=0):
+        """
+        Returns:
+            np.ndarray: [units] Cohen's d of plural against singular sentences,
+                        by the number in the given column, with pooled variance
+        """
+        n_sg, mean_sg, var_sg = self.moments(value, position, column, 0)
+        n_pl, mean_pl, var_pl = self.moments(value, position, column, 1)
+        pooled = ((n_sg - 1) * var_sg + (n_pl - 1) * var_pl)\
+            / np.maximum(n_sg + n_pl - 2, 1)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            return (mean_pl - mean_sg) / np.sqrt(pooled)
+
+    def table(self, rank_by=0):
+        """
+        Args:
+            rank_by (int): number column whose effect size orders the table
+        Returns:
+            pandas.DataFrame: for every value, position and unit, the means for
+                              singular and plural in the rank_by column and the
+                              effect size of every number column, ordered by
+                              decreasing absolute effect size
+        """
+        n_numbers = self.numbers.shape[1]
+        if not 0 <= rank_by < n_numbers:
+            raise ValueError(f"No number column {rank_by}")
+
+        frames = []
+        for v in self.values:
+            for p in self.positions:
+                frame = pd.DataFrame({"value": v, "position": p,
+                    "unit": np.arange(self.mean[v, p].shape[1])})
+                frame["mean_singular"] = self.moments(v, p, rank_by, 0)[1]
+                frame["mean_plural"] = self.moments(v, p, rank_by, 1)[1]
+                for j in range(n_numbers):
+                    frame[f"d_number{j + 1}"] = self.effect_size(v, p, j)
+                frames.append(frame)
+
+        df = pd.concat(frames, ignore_index=True)
+        order = df[f"d_number{rank_by + 1}"].abs().sort_values(ascending=False,
+            na_position="last").index
+        return df.loc[order].reset_index(drop=True)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-m", "--model", type=str, default="models/model.pt",
+        help="Model (meta file) to use")
+    parser.add_argument("-i", "--input", type=str, nargs="+", required=True,
+        help="Input sentences (tsv files or directories of tsv files)")
+    parser.add_argument("-o", "--output", type=str, default="output_statistics",
+        help="Output directory for the .info files and unit tables")
+    parser.add_argument("--values", type=str, nargs="+", default=VALUES,
+        choices=VALUES, help="Activations to collect statistics of")
+    parser.add_argument("--rank_by", type=int, default=1,
+        help="Number column (1 for number1...) to rank the units by")
+    parser.add_argument("--top", type=int, default=20,
+        help="Number of units to print per template")
+    add_evaluation_arguments(parser)
+    args = parser.parse_args()
+
+    vocab = data.Dictionary(args.vocabulary)
+    tasks = read_tasks(args.input, vocab, args.unk)
+    model = load_model(args.model, args.cuda)
+    store = ResultsStore(args.results_db) if args.results_db else None
+    if not os.path.exists(args.output):
+        os.makedirs(args.output)
+
+    cache = None
+    if args.warm_up_cache:
+        cache = WarmUpCache(checkpoint_hash(args.model), args.warm_up_cache)
+    init_h = cached_warm_up(model, vocab, args.cuda,
+        " ".join([f". {args.eos}"] * 5), cache)
+
+    for template, task_data, task in tasks:
+        if task["numbers"].shape[1] < args.rank_by:
+            sys.exit(f"{template} has no number{args.rank_by} column")
+
+        # The statistics are collected during the normal evaluation
+        print(f"Evaluating {template}")
+        statistics = UnitStatistics(task, model.nhid, model.nlayers, args.values)
+        info = evaluate_task(task_data, task, model, init_h, vocab, args,
+            statistics.hook)
+
+        with open(os.path.join(args.output, f"{template}.info"), "wb") as f:
+            pickle.dump(info, f, -1)
+        if store is not None:
+            store.append(args.model, template, [(None, info)],
+                log_probs=args.store_log_probs)
+
+        df = statistics.table(args.rank_by - 1)
+        df.to_csv(os.path.join(args.output, f"{template}.units.csv"), index=False)
+        print(df.head(args.top))
+        print(f"Unit statistics saved to {args.output}/{template}.units.csv\n")